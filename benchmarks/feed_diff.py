@@ -0,0 +1,102 @@
+# Micro-benchmark of one RSS tick: entry parsing plus diffing against the previous feed.
+# "before" is the dict + json.dumps set diff check_for_updates used to do, "after" is every per-tick step it does now:
+# the key -> release dict, the candidates not in self.seen, the ledger check and the seen set for the next tick.
+# The ledger is an in-memory stand-in doing the same work as Mongo.unseen_releases on the result, not the round trip.
+#   python -m benchmarks.feed_diff --rounds 2000
+import argparse
+import json
+import os
+import re
+import timeit
+import feedparser
+from core.rss import RSSParser
+
+DEFAULT_FEED = os.path.join(os.path.dirname(__file__), "data", "releases_rss.xml")
+
+
+def legacy_parse_entries(entries):
+    manga_list = []
+    for entry in entries:
+        title = entry.title
+        try:
+            chapter = re.search(r"(v.\d{1,} )?c.\d{1,}(\.\d)?(-\d{1,}(\.\d)?)?", title).group()
+            title = title[0: len(title) - len(chapter) - 1]
+        except:
+            chapter = None
+        try:
+            scan_group = re.search(r"(?<=\[).+?(?=\])", title).group()
+            title = re.sub(r"(?<=\[).+?(?=\])", "", title)[3:]
+        except:
+            scan_group = None
+        try:
+            if (re.match("^http://", entry.link)):
+                link = re.sub("^http://", "https://", entry.link)
+            else:
+                link = entry.link
+        except:
+            link = None
+        manga_list.append({"title": title, "chapter": chapter, "scan_group": scan_group, "link": link})
+    return manga_list
+
+
+def legacy_diff(new, old):
+    tempNew = set(json.dumps(x, sort_keys=True) for x in new)
+    tempOld = set(json.dumps(x, sort_keys=True) for x in old)
+    return [json.loads(x) for x in (tempNew - tempOld)]
+
+
+def unseen_releases(ledger, fingerprints):
+    # Mongo.unseen_releases without the query, ledger holds every key marked seen
+    found = set(fp for fp in fingerprints if fp in ledger)
+    return [fp for fp in fingerprints if fp not in found]
+
+
+def keyed_tick(new, seen, ledger):
+    current = {x.key: x for x in new}
+    candidates = [key for key in current if key not in seen]
+    new_keys = unseen_releases(ledger, candidates) if candidates else []
+    return [current[key] for key in new_keys], set(current)
+
+
+def report(name, before, after, rounds):
+    b = before / rounds * 1e6
+    a = after / rounds * 1e6
+    print(f"{name:>6}: before {b:9.1f}us  after {a:9.1f}us  ({b / a if a else 0:.1f}x)")
+
+
+def main(args):
+    with open(args.feed, "rb") as f:
+        entries = feedparser.parse(f.read()).entries
+    # a tick where `shift` releases were published since the last one
+    new_entries = entries[:len(entries) - args.shift]
+    old_entries = entries[args.shift:]
+    parser = RSSParser(None)
+
+    legacy_new = legacy_parse_entries(new_entries)
+    legacy_old = legacy_parse_entries(old_entries)
+    releases_new = parser.parse_entries(new_entries)
+    seen = set(x.key for x in parser.parse_entries(old_entries))
+    ledger = set(seen)
+    assert len(legacy_diff(legacy_new, legacy_old)) == len(keyed_tick(releases_new, seen, ledger)[0])
+
+    print(f"{len(new_entries)} entries per feed, {args.shift} new per tick, {args.rounds} rounds")
+    report("parse",
+           timeit.timeit(lambda: legacy_parse_entries(new_entries), number=args.rounds),
+           timeit.timeit(lambda: parser.parse_entries(new_entries), number=args.rounds),
+           args.rounds)
+    report("diff",
+           timeit.timeit(lambda: legacy_diff(legacy_new, legacy_old), number=args.rounds),
+           timeit.timeit(lambda: keyed_tick(releases_new, seen, ledger), number=args.rounds),
+           args.rounds)
+    report("tick",
+           timeit.timeit(lambda: legacy_diff(legacy_parse_entries(new_entries), legacy_old), number=args.rounds),
+           timeit.timeit(lambda: keyed_tick(parser.parse_entries(new_entries), seen, ledger), number=args.rounds),
+           args.rounds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--feed", default=DEFAULT_FEED, help="rss snapshot to replay")
+    parser.add_argument("--shift", type=int, default=5)
+    parser.add_argument("--rounds", type=int, default=1000)
+    main(parser.parse_args())
@@ -0,0 +1,94 @@
+# Compares the old blocking pymongo calls against the executor-backed Mongo layer.
+# Runs against mongomock by default, pass --uri to use a local mongod instead.
+#   python -m benchmarks.mongo_latency --uri mongodb://localhost:27017 --servers 5000
+import argparse
+import asyncio
+import statistics
+import time
+from core.metrics import percentile
+from core.mongodb import Mongo
+
+
+def seed(mongo, servers):
+    mongo.srv.delete_many({})
+    docs = []
+    for i in range(servers):
+        docs.append({"_id": i, "serverid": 10_000 + i, "serverName": f"server {i}", "channelid": 20_000 + i, "manga": [{"title": f"Series {i % 500}", "id": i % 500}]})
+    mongo.srv.insert_many(docs)
+
+
+async def legacy_get_server(mongo, server_id):
+    # what Mongo.get_server did before: a synchronous call straight on the event loop
+    return mongo.srv.find_one({"serverid": server_id})
+
+
+async def legacy_get_manga_list_server(mongo, server_id):
+    return mongo.srv.find_one({"serverid": server_id}, {"manga": 1})
+
+
+async def heartbeat(stop, interval, lags):
+    # stands in for the gateway heartbeat, records how late each wakeup was
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append((time.perf_counter() - start - interval) * 1000)
+
+
+async def run_path(name, calls, concurrency, servers, lookup, manga_list):
+    latencies = []
+    lags = []
+    stop = asyncio.Event()
+    beat = asyncio.create_task(heartbeat(stop, 0.005, lags))
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with sem:
+            start = time.perf_counter()
+            server_id = 10_000 + (i % servers)
+            if i % 2:
+                await lookup(server_id)
+            else:
+                await manga_list(server_id)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(calls)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await beat
+    print(f"{name:>8}: {calls / elapsed:9.1f} ops/s  "
+          f"p50 {percentile(latencies, 50):7.2f}ms  p99 {percentile(latencies, 99):7.2f}ms  "
+          f"loop lag mean {statistics.fmean(lags) if lags else 0:6.2f}ms max {max(lags) if lags else 0:7.2f}ms  "
+          f"heartbeats {len(lags)}")
+
+
+async def main(args):
+    if args.uri:
+        from pymongo import MongoClient
+        client = MongoClient(args.uri, maxPoolSize=args.concurrency)
+    else:
+        import mongomock
+        client = mongomock.MongoClient()
+    mongo = Mongo(client=client, database_name=args.db)
+    await mongo.run("seed", seed, mongo, args.servers)
+    await mongo.run("seed", mongo.srv.create_index, "serverid")
+
+    await run_path("blocking", args.calls, args.concurrency, args.servers,
+                   lambda sid: legacy_get_server(mongo, sid),
+                   lambda sid: legacy_get_manga_list_server(mongo, sid))
+    await run_path("executor", args.calls, args.concurrency, args.servers,
+                   mongo.get_server,
+                   mongo.get_manga_list_server)
+    if args.uri:
+        await mongo.run("drop", mongo.srv.drop)
+    mongo.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uri", default=None, help="mongodb uri, mongomock is used when omitted")
+    parser.add_argument("--db", default="mangaupdates_bench")
+    parser.add_argument("--servers", type=int, default=2000)
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
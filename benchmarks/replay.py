@@ -0,0 +1,369 @@
+# Replays RSS snapshots through the real update pipeline: RSSParser.parse_feed, UpdateSending.check_for_updates,
+# the release queue and notify, against a local MangaUpdates API stub, mongomock (or a local mongod) seeded with
+# synthetic servers and users, and a fake Discord that only records what was sent.
+# A single snapshot is replayed as a sliding window with --shift new releases per tick, several --feed files are
+# served one per tick in the order given.
+#   python -m benchmarks.replay --servers 2000 --users 5000 --ticks 10 --shift 5
+#   python -m benchmarks.replay --uri mongodb://localhost:27017 --discord-latency 40 --global-rate 45
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import re
+import time
+import zlib
+import feedparser
+from aiohttp import web
+import aiohttp
+from core.rss import RSSParser
+from core.groups import GroupResolver
+from core.metrics import MONGO_SECONDS, percentile
+from core.mongodb import Mongo
+from core.mangaupdates import MangaUpdates
+from core.series import SeriesIndex
+from core.config import ConfigCache
+from core.services import Services
+from core.outbound import OutboundScheduler
+from core.oplog import OpLog
+from core.delivery import DMChannels
+from cogs.update_sending import UpdateSending
+
+DEFAULT_FEED = os.path.join(os.path.dirname(__file__), "data", "releases_rss.xml")
+ITEM_RE = re.compile(rb"<item>.*?</item>\s*", re.S)
+LOG_CHANNEL = 1
+
+
+def group_id(name):
+    return zlib.crc32(GroupResolver.normalize(name).encode())
+
+
+def snapshots(feeds, ticks, shift):
+    # tick 0 is the feed the bot starts with, every later one has new releases on top
+    if len(feeds) > 1:
+        out = []
+        for path in feeds:
+            with open(path, "rb") as f:
+                out.append(f.read())
+        return out
+    with open(feeds[0], "rb") as f:
+        body = f.read()
+    items = ITEM_RE.findall(body)
+    head, tail = body[:body.index(items[0])], body[body.index(items[-1]) + len(items[-1]):]
+    window = len(items) - ticks * shift
+    if window <= 0:
+        raise SystemExit(f"{len(items)} releases in the snapshot, not enough for {ticks} ticks of {shift}")
+    return [head + b"".join(items[(ticks - t) * shift:(ticks - t) * shift + window]) + tail for t in range(ticks + 1)]
+
+
+class ApiStub:
+    # the few MangaUpdates endpoints the pipeline calls, plus the rss feed, served from memory
+    def __init__(self, feeds, series, latency):
+        self.feeds = feeds
+        self.series = series
+        self.latency = latency
+        self.tick = 0
+        self.calls = {}
+        self.runner = None
+        self.base = None
+
+    def count(self, endpoint):
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    async def rss(self, request):
+        self.count("rss")
+        # a new etag every tick, so the parser never gets a 304 here
+        return web.Response(body=self.feeds[self.tick], content_type="application/rss+xml", headers={"ETag": f'"{self.tick}"'})
+
+    async def login(self, request):
+        self.count("login")
+        return web.json_response({"context": {"session_token": "bench"}})
+
+    async def series_info(self, request):
+        self.count("series")
+        await asyncio.sleep(self.latency)
+        series_id = int(request.match_info["id"])
+        title = self.series.get(series_id, f"Series {series_id}")
+        return web.json_response({"series_id": series_id, "title": title, "url": f"https://www.mangaupdates.com/series/{series_id}",
+                                  "image": {"url": {"original": f"https://cdn.mangaupdates.com/image/{series_id}.jpg"}}})
+
+    async def group_search(self, request):
+        self.count("groups/search")
+        await asyncio.sleep(self.latency)
+        name = (await request.json())["search"]
+        record = {"group_id": group_id(name), "name": name, "url": f"https://www.mangaupdates.com/group/{group_id(name)}",
+                  "social": {"site": f"https://{re.sub('[^a-z0-9]', '', name.lower())}.example", "discord": None, "forum": None}}
+        return web.json_response({"results": [{"record": record}]})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/v1/releases/rss", self.rss)
+        app.router.add_put("/v1/account/login", self.login)
+        app.router.add_get("/v1/series/{id}", self.series_info)
+        app.router.add_post("/v1/groups/search", self.group_search)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.base = "http://127.0.0.1:%d" % self.runner.addresses[0][1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+class StubSession:
+    # hands every mangaupdates url to the stub, the code under test keeps its real urls
+    def __init__(self, session, base):
+        self.session = session
+        self.base = base
+
+    def rewrite(self, url):
+        return re.sub(r"^https://(api|www)\.mangaupdates\.com", self.base, str(url))
+
+    def request(self, method, url, **kwargs):
+        return self.session.request(method, self.rewrite(url), **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+class DiscordSink:
+    # stands in for the discord http api, records every notification and when it landed
+    def __init__(self, latency):
+        self.latency = latency
+        self.published = {}
+        self.latencies = []
+        self.completed = {}
+        self.messages = 0
+        self.logs = 0
+
+    async def send(self, channel_id, content=None, embed=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        if channel_id == LOG_CHANNEL:
+            self.logs += 1
+            return
+        self.messages += 1
+        now = time.perf_counter()
+        # a series link is shared by all its chapters, the chapter field tells releases apart
+        release = (embed.url, embed.fields[0].value) if embed is not None else None
+        published = self.published.get(release)
+        if published is not None:
+            self.latencies.append(now - published)
+            self.completed[release] = now
+
+
+class FakeChannel:
+    def __init__(self, sink, channel_id):
+        self.sink = sink
+        self.id = channel_id
+
+    async def send(self, **kwargs):
+        return await self.sink.send(self.id, **kwargs)
+
+
+class FakeUser:
+    def __init__(self, sink, user_id):
+        self.sink = sink
+        self.id = user_id
+        self.avatar = type("Avatar", (), {"url": "https://cdn.discordapp.com/embed/avatars/0.png"})()
+
+
+class FakeBot:
+    def __init__(self, services, sink, global_rate, route_rate):
+        self.services = services
+        self.sink = sink
+        self.user = FakeUser(sink, 0)
+        self.fetched_users = 0
+        self.opened_dms = 0
+        self.outbound = OutboundScheduler(self, global_rate=global_rate, route_rate=route_rate, log_channel_id=LOG_CHANNEL, log_interval=0.1)
+        self.ops = OpLog(self.outbound, path=None)
+
+    async def wait_until_ready(self):
+        return
+
+    def get_channel(self, channel_id):
+        return FakeChannel(self.sink, channel_id)
+
+    def get_partial_messageable(self, channel_id, type=None):
+        return FakeChannel(self.sink, channel_id)
+
+    async def create_dm(self, user):
+        self.opened_dms += 1
+        await asyncio.sleep(self.sink.latency)
+        return FakeChannel(self.sink, 10 ** 12 + user.id)
+
+    async def fetch_user(self, user_id):
+        self.fetched_users += 1
+        await asyncio.sleep(self.sink.latency)
+        return FakeUser(self.sink, user_id)
+
+    def get_cog(self, name):
+        return None
+
+
+def seed_docs(releases, args):
+    # every account follows --follows series from the feed, some of them only from one of its groups
+    rng = random.Random(args.seed)
+    series = {}
+    for release in releases:
+        if release.series_id() is not None:
+            series.setdefault(release.series_id(), {"title": release.title, "groups": set()})
+            series[release.series_id()]["groups"].update(GroupResolver.split(release.scan_group or ""))
+    ids = sorted(series)
+
+    def manga_list():
+        out = []
+        for series_id in rng.sample(ids, min(args.follows, len(ids))):
+            manga = {"id": series_id, "title": series[series_id]["title"]}
+            groups = sorted(series[series_id]["groups"])
+            if groups and rng.random() < args.group_filter:
+                name = rng.choice(groups)
+                manga["groupid"] = group_id(name)
+                manga["groupName"] = name
+            out.append(manga)
+        return out
+
+    servers = [{"serverid": 10 ** 6 + i, "serverName": f"server {i}", "channelid": 10 ** 9 + i, "manga": manga_list()} for i in range(args.servers)]
+    users = [{"userid": 10 ** 7 + i, "username": f"user {i}", "manga": manga_list()} for i in range(args.users)]
+    return servers, users, {series_id: meta["title"] for series_id, meta in series.items()}
+
+
+def mongo_queries():
+    return {key[0]: series["count"] for key, series in MONGO_SECONDS.values.items()}
+
+
+async def main(args):
+    feeds = snapshots(args.feed, args.ticks, args.shift)
+    parsed = [RSSParser(None).parse_entries(feedparser.parse(body).entries) for body in feeds]
+    releases = [r for feed in parsed for r in feed]
+    servers, users, titles = seed_docs(releases, args)
+
+    if args.uri:
+        from pymongo import MongoClient
+        client = MongoClient(args.uri)
+    else:
+        import mongomock
+        client = mongomock.MongoClient()
+    mongo = Mongo(client=client, database_name=args.db, use_subscriptions=False)
+    for collection in (mongo.srv, mongo.usr, mongo.rls, mongo.series, mongo.groups):
+        await mongo.run("drop", collection.drop)
+    await mongo.ensure_indexes()
+    if servers:
+        await mongo.run("seed", mongo.srv.insert_many, servers)
+    if users:
+        await mongo.run("seed", mongo.usr.insert_many, users)
+
+    stub = ApiStub(feeds, titles, args.api_latency / 1000)
+    await stub.start()
+    session = aiohttp.ClientSession()
+    services = Services()
+    services.session = StubSession(session, stub.base)
+    services.mongo = mongo
+    services.mangaupdates = MangaUpdates(services.session)
+    services.rss = RSSParser(services.session)
+    services.groups = GroupResolver(services.mangaupdates, store=mongo)
+    services.mangaupdates.on_group = services.groups.remember
+    services.series = SeriesIndex(services.mangaupdates, store=mongo)
+    if args.config_cache:
+        services.config = ConfigCache(mongo)
+        mongo.config = services.config
+        await services.config.start()
+
+    sink = DiscordSink(args.discord_latency / 1000)
+    bot = FakeBot(services, sink, args.global_rate, args.route_rate)
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        cog = UpdateSending(bot)
+        # ticks are driven from here instead of every 15 seconds
+        cog.check_for_updates.cancel()
+        await cog.before_printer()
+        queries = mongo_queries()
+        calls = dict(stub.calls)
+        new_releases = 0
+        fresh = []
+        started = time.perf_counter()
+        for tick in range(1, len(feeds)):
+            stub.tick = tick
+            previous = set(r.key for r in parsed[tick - 1])
+            fresh = [r for r in parsed[tick] if r.key not in previous]
+            new_releases += len(fresh)
+            tick_started = time.perf_counter()
+            for release in fresh:
+                sink.published.setdefault((release.link, release.chapter), tick_started)
+            await cog.check_for_updates()
+            if args.interval:
+                await asyncio.sleep(args.interval)
+        while cog.jobs.queue.qsize() or cog.jobs.in_flight or cog.jobs.waiting:
+            await cog.jobs.queue.join()
+            await asyncio.sleep(0)
+        elapsed = time.perf_counter() - started
+        await cog.jobs.stop()
+        bot.ops.flush()
+
+    queries = {op: count - queries.get(op, 0) for op, count in mongo_queries().items() if count - queries.get(op, 0)}
+    calls = {endpoint: count - calls.get(endpoint, 0) for endpoint, count in stub.calls.items() if count - calls.get(endpoint, 0)}
+    total_queries = sum(queries.values())
+    api_calls = sum(count for endpoint, count in calls.items() if endpoint not in ("rss", "login"))
+    completion = [sink.completed[release] - sink.published[release] for release in sink.completed]
+    per = max(new_releases, 1)
+
+    print(f"{len(feeds) - 1} ticks, {new_releases} new releases, {len(servers)} servers and {len(users)} users following {args.follows} series each"
+          f"{', config cache' if args.config_cache else ''}{', ' + args.uri if args.uri else ', mongomock'}")
+    print(f"throughput: {new_releases / elapsed:8.1f} releases/s  {sink.messages / elapsed:8.1f} messages/s  ({sink.messages} messages in {elapsed:.2f}s)")
+    print(f"database:   {total_queries / per:8.2f} queries/release  ({total_queries} total: " + ", ".join(f"{m} {c}" for m, c in sorted(queries.items(), key=lambda x: -x[1])) + ")")
+    print(f"api:        {api_calls / per:8.2f} calls/release    ({api_calls} total: " + ", ".join(f"{e} {c}" for e, c in sorted(calls.items())) + ")")
+    print(f"delivery:   p50 {percentile(sink.latencies, 50) * 1000:7.1f}ms  p95 {percentile(sink.latencies, 95) * 1000:7.1f}ms  "
+          f"p99 {percentile(sink.latencies, 99) * 1000:7.1f}ms  max {max(sink.latencies, default=0) * 1000:7.1f}ms  (tick start to message sent)")
+    print(f"release:    p50 {percentile(completion, 50) * 1000:7.1f}ms  p99 {percentile(completion, 99) * 1000:7.1f}ms  (tick start to its last message)")
+    print(f"discord:    {bot.fetched_users} fetch_user calls, {bot.opened_dms} dms opened, {sink.logs} log messages, dm cache {cog.dms.stats()}")
+
+    if fresh and users:
+        # a release to users that were already sent one, after a restart: the stored dm channels have to cover all of them
+        fetched, opened, cog.dms = bot.fetched_users, bot.opened_dms, DMChannels(bot, mongo, bot.outbound)
+        with output:
+            release = fresh[0]
+            lookup = cog.lookup(release)
+            wanted = (await mongo.manga_wanted_batch([lookup]))[lookup]
+            await cog.notify(release.title, release.chapter, release.scan_group, release.link, wanted, services.series.get(lookup[0]))
+        repeat = bot.fetched_users - fetched + bot.opened_dms - opened
+        print(f"repeat:     {bot.fetched_users - fetched} fetch_user calls and {bot.opened_dms - opened} dms opened for {cog.dms.stored} users sent a second release after a restart")
+        assert repeat == 0, f"{repeat} discord calls to reach users that already have a stored dm channel"
+
+    if services.config is not None:
+        await services.config.stop()
+    await session.close()
+    await stub.stop()
+    if args.uri:
+        await mongo.run("drop", client.drop_database, args.db)
+    mongo.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--feed", action="append", default=None, help="rss snapshot, repeat to replay several in order")
+    parser.add_argument("--ticks", type=int, default=10, help="ticks cut from a single snapshot")
+    parser.add_argument("--shift", type=int, default=5, help="new releases per tick cut from a single snapshot")
+    parser.add_argument("--interval", type=float, default=0, help="seconds between ticks, 0 replays back to back")
+    parser.add_argument("--servers", type=int, default=500)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--follows", type=int, default=10, help="series each server/user follows")
+    parser.add_argument("--group-filter", type=float, default=0.1, help="share of follows limited to one scan group")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--api-latency", type=float, default=20, help="ms per MangaUpdates API call")
+    parser.add_argument("--discord-latency", type=float, default=0, help="ms per Discord request")
+    parser.add_argument("--global-rate", type=float, default=10 ** 6, help="outbound requests/s, 45 for Discord's real limit")
+    parser.add_argument("--route-rate", type=int, default=5, help="messages per channel per 5s")
+    parser.add_argument("--config-cache", action="store_true", help="answer subscribers from ConfigCache")
+    parser.add_argument("--uri", default=None, help="mongodb uri, mongomock is used when omitted")
+    parser.add_argument("--db", default="mangaupdates_replay")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's own output")
+    args = parser.parse_args()
+    args.feed = args.feed or [DEFAULT_FEED]
+    asyncio.run(main(args))
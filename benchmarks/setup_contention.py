@@ -0,0 +1,112 @@
+# Hammers server and user setup from many coroutines at once, the way parallel /server setup and /user setup
+# invocations hit Mongo, and compares the old count-and-retry _id allocation against the upsert in Mongo.add_server/add_user.
+# Every account is set up several times concurrently: the upsert must create exactly one document per id in O(1)
+# round trips, while the old path needs more round trips as the collection grows and loses setups, its _id retries run
+# out below the document count and the account is never created (280 to 290 documents for 300 ids with the defaults).
+# Runs against mongomock by default, pass --uri to use a local mongod instead.
+#   python -m benchmarks.setup_contention --uri mongodb://localhost:27017 --accounts 2000 --repeat 4
+import argparse
+import asyncio
+import random
+import time
+from core.mongodb import Mongo
+
+
+async def legacy_add(mongo, collection, id_field, doc, counter):
+    # what the setup commands did before: check_*_exist, then Mongo.add_server/add_user
+    counter[0] += 2
+    if await mongo.run("legacy_find", collection.find_one, {id_field: doc[id_field]}) is not None:
+        return False
+    document_count = await mongo.run("legacy_count", collection.count_documents, {})
+    while document_count >= 0:
+        counter[0] += 1
+        try:
+            await mongo.run("legacy_insert", collection.insert_one, dict(doc, _id=document_count))
+            return True
+        except Exception:
+            document_count -= 1
+
+
+async def hammer(mongo, accounts, repeat, concurrency, add):
+    calls = [i for i in range(accounts) for _ in range(repeat)]
+    random.Random(1).shuffle(calls)
+    sem = asyncio.Semaphore(concurrency)
+    created = [0]
+
+    async def one(i):
+        async with sem:
+            if await add(i):
+                created[0] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in calls])
+    return time.perf_counter() - start, created[0], len(calls)
+
+
+def report(name, kind, collection, id_field, accounts, elapsed, created, calls, round_trips):
+    counts = {}
+    for doc in collection.find({}, {id_field: 1}):
+        counts[doc[id_field]] = counts.get(doc[id_field], 0) + 1
+    missing = [i for i in range(accounts) if i not in counts]
+    duplicated = sorted(i for i, count in counts.items() if count > 1)
+    print(f"{name:>8} {kind:>7}: {calls / elapsed:8.1f} setups/s  {round_trips / calls:7.2f} round trips/setup  "
+          f"{sum(counts.values())} documents for {accounts} ids ({len(missing)} missing, {len(duplicated)} duplicated, {created} reported created)")
+    if missing:
+        print(f"{'':>17} missing ids: {missing[:20]}{' ...' if len(missing) > 20 else ''}")
+    if duplicated:
+        print(f"{'':>17} duplicated ids: {duplicated[:20]}{' ...' if len(duplicated) > 20 else ''}")
+    return missing, duplicated, created
+
+
+def check(result, accounts):
+    # the upsert path has to end with exactly one document per id, each reported created once
+    missing, duplicated, created = result
+    assert not missing, f"upsert lost {len(missing)} setups"
+    assert not duplicated, f"upsert duplicated {len(duplicated)} ids"
+    assert created == accounts, f"upsert reported {created} created for {accounts} ids"
+
+
+async def main(args):
+    if args.uri:
+        from pymongo import MongoClient
+        client = MongoClient(args.uri, maxPoolSize=args.concurrency)
+    else:
+        import mongomock
+        client = mongomock.MongoClient()
+    mongo = Mongo(client=client, database_name=args.db)
+
+    # legacy: no unique index on serverid/userid, like the collections the old path ran against
+    for collection in (mongo.srv, mongo.usr):
+        await mongo.run("drop", collection.drop)
+    counter = [0]
+    elapsed, created, calls = await hammer(mongo, args.accounts, args.repeat, args.concurrency,
+                                           lambda i: legacy_add(mongo, mongo.srv, "serverid", {"serverid": i, "serverName": f"server {i}", "channelid": i, "manga": []}, counter))
+    report("legacy", "servers", mongo.srv, "serverid", args.accounts, elapsed, created, calls, counter[0])
+    counter = [0]
+    elapsed, created, calls = await hammer(mongo, args.accounts, args.repeat, args.concurrency,
+                                           lambda i: legacy_add(mongo, mongo.usr, "userid", {"userid": i, "username": f"user {i}", "manga": []}, counter))
+    report("legacy", "users", mongo.usr, "userid", args.accounts, elapsed, created, calls, counter[0])
+
+    for collection in (mongo.srv, mongo.usr):
+        await mongo.run("drop", collection.drop)
+    await mongo.ensure_indexes()
+    elapsed, created, calls = await hammer(mongo, args.accounts, args.repeat, args.concurrency,
+                                           lambda i: mongo.add_server(f"server {i}", i, i))
+    check(report("upsert", "servers", mongo.srv, "serverid", args.accounts, elapsed, created, calls, calls), args.accounts)
+    elapsed, created, calls = await hammer(mongo, args.accounts, args.repeat, args.concurrency,
+                                           lambda i: mongo.add_user(f"user {i}", i))
+    check(report("upsert", "users", mongo.usr, "userid", args.accounts, elapsed, created, calls, calls), args.accounts)
+
+    if args.uri:
+        await mongo.run("drop", client.drop_database, args.db)
+    mongo.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uri", default=None, help="mongodb uri, mongomock is used when omitted")
+    parser.add_argument("--db", default="mangaupdates_bench")
+    parser.add_argument("--accounts", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=3, help="concurrent setups per account")
+    parser.add_argument("--concurrency", type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
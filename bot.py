@@ -2,32 +2,125 @@ import discord
 from discord.ext import commands
 from dotenv import load_dotenv
 import os
-from core.mongodb import Mongo
+from core.services import Services
+from core.outbound import OutboundScheduler
+from core.oplog import OpLog
+from core.metrics import REGISTRY
 
 load_dotenv()
-mongo = Mongo()
 
-bot = commands.AutoShardedBot(intents=discord.Intents(guilds=True))
-bot.remove_command("help")
 
-for file in os.listdir("./cogs"):
-    if file.endswith(".py"):
-        name = file[:-3]
-        bot.load_extension(f"cogs.{name}")
+def oplog_path():
+    # one file per cluster, rotating handlers can't share a file between processes
+    path = os.environ.get("OPLOG_PATH", "ops.jsonl")
+    if path and os.environ.get("CLUSTER_ID"):
+        root, ext = os.path.splitext(path)
+        path = f"{root}-{os.environ['CLUSTER_ID']}{ext}"
+    return path
 
 
-@bot.event
-async def on_ready():
-    print(f"Bot is online.")
-    await bot.change_presence(activity=discord.Game(name="/help"))
+class MangaUpdatesBot(commands.AutoShardedBot):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.services = Services()
+        self.outbound = OutboundScheduler(self, log_channel_id=int(os.environ.get("LOG_CHANNEL_ID", 990005048408936529)))
+        self.ops = OpLog(self.outbound, path=oplog_path())
 
+    async def start(self, *args, **kwargs):
+        await self.services.start()
+        await super().start(*args, **kwargs)
 
-@bot.event
-async def on_guild_remove(guild):
-    mongo.remove_server(guild.id)
+    async def close(self):
+        await super().close()
+        await self.services.close()
+        self.ops.close()
 
+    def cluster_health(self):
+        updates = self.get_cog("UpdateSending")
+        return {
+            "shards": sorted(self.shards),
+            "guilds": len(self.guilds),
+            "latency": self.latency,
+            "ready": self.is_ready(),
+            "leader": self.services.lease is not None and self.services.lease.held,
+            "queue": updates.jobs.stats() if updates is not None and updates.jobs is not None else None,
+            "outbound": self.outbound.stats(),
+            "ops": self.ops.stats(),
+            "dms": updates.dms.stats() if updates is not None and updates.dms is not None else None,
+        }
 
-try:
-    bot.run(os.environ.get("TOKEN"))
-except Exception as err:
-    print(f"Error: {err}")
+
+    def component_stats(self):
+        # every numeric counter the components already keep, flattened into (component, stat) for the metrics endpoint
+        updates = self.get_cog("UpdateSending")
+        services = self.services
+        components = {
+            "queue": updates.jobs.stats() if updates is not None and updates.jobs is not None else None,
+            "dms": updates.dms.stats() if updates is not None and updates.dms is not None else None,
+            "outbound": self.outbound.stats(),
+            "ops": self.ops.stats(),
+            "config": services.config.stats() if services.config is not None else None,
+            "groups": services.groups.stats() if services.groups is not None else None,
+            "series": services.series.stats() if services.series is not None else None,
+            # one set of hit/miss/coalesced/eviction counters per cache, e.g. stat="series_info_hits"
+            "api_cache": services.mangaupdates.cache_stats() if services.mangaupdates is not None else None,
+            # logins vs requests shows how often the cached session token was reused
+            "mu_api": services.mangaupdates.rq.stats() if services.mangaupdates is not None else None,
+            # conditional GETs, not_modified out of fetches is how often the feed didn't need parsing
+            "rss": {"fetches": services.rss.fetches, "not_modified": services.rss.not_modified} if services.rss is not None else None,
+            "watchdog": services.watchdog.stats() if services.watchdog is not None else None,
+            "cluster": {"published": services.cluster.published, "received": services.cluster.received, "unrouted": services.cluster.unrouted} if services.cluster is not None else None,
+        }
+        values = {}
+
+        def flatten(component, prefix, stats):
+            for name, value in stats.items():
+                if isinstance(value, dict):
+                    flatten(component, f"{prefix}{name}_", value)
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    values[(component, prefix + name)] = value
+        for component, stats in components.items():
+            if stats:
+                flatten(component, "", stats)
+        return values
+
+    def context_stats(self):
+        stats = self.services.mongo.context_stats if self.services.mongo is not None else {}
+        return {(command, name): value for command, counts in stats.items() for name, value in counts.items()}
+
+
+def create_bot(**kwargs):
+    # kwargs go to AutoShardedBot, the cluster launcher passes shard_ids and shard_count
+    bot = MangaUpdatesBot(intents=discord.Intents(guilds=True), **kwargs)
+    bot.remove_command("help")
+    REGISTRY.gauge("mu_component_stat", "Counters kept by the queue, caches, scheduler and cluster client", ("component", "stat"), function=bot.component_stats)
+    REGISTRY.gauge("mu_command_context", "Document loads and answers per command from AccountContext", ("command", "stat"), function=bot.context_stats)
+    # latency is nan until the first heartbeat
+    REGISTRY.gauge("mu_discord_latency_seconds", "Gateway heartbeat latency", function=lambda: None if bot.latency != bot.latency else bot.latency)
+
+    for file in os.listdir("./cogs"):
+        if file.endswith(".py"):
+            name = file[:-3]
+            bot.load_extension(f"cogs.{name}")
+
+    @bot.event
+    async def on_ready():
+        print(f"Bot is online.")
+        await bot.change_presence(activity=discord.Game(name="/help"))
+        # on_ready fires again after reconnects, start_health only starts once
+        if bot.services.cluster is not None:
+            bot.services.cluster.start_health(bot.cluster_health)
+
+    @bot.event
+    async def on_guild_remove(guild):
+        await bot.services.mongo.remove_server(guild.id)
+
+    return bot
+
+
+if __name__ == "__main__":
+    bot = create_bot()
+    try:
+        bot.run(os.environ.get("TOKEN"))
+    except Exception as err:
+        print(f"Error: {err}")
@@ -0,0 +1,230 @@
+# Runs the bot as several processes ("clusters"), each with its own slice of the shards, event loop and connection pools.
+# The clusters connect back to a small hub in this process over a unix socket: one of them (whichever holds the rss
+# lease in mongo) polls the feed and publishes releases to the hub, the hub routes each server subscriber to the
+# cluster that owns the guild's shard and each user to a fixed cluster, and every cluster reports its health here.
+# Dead clusters are restarted, releases for a cluster that is down wait in the hub until it is back. The hub confirms
+# every release to the leader, which only marks it seen once every cluster's part was sent or is waiting here.
+#   python cluster.py [--clusters 4] [--shards 16]
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+from collections import OrderedDict, deque
+import aiohttp
+from dotenv import load_dotenv
+from core.cluster import LINE_LIMIT, shard_for, user_cluster
+
+load_dotenv()
+
+
+def run_cluster(cluster_id, cluster_count, shard_ids, shard_count, socket_path):
+    # runs in the child process, the environment tells Services to connect to the hub
+    os.environ["CLUSTER_ID"] = str(cluster_id)
+    os.environ["CLUSTER_COUNT"] = str(cluster_count)
+    os.environ["CLUSTER_SOCKET"] = socket_path
+    from bot import create_bot
+    bot = create_bot(shard_ids=shard_ids, shard_count=shard_count)
+    print(f"Cluster {cluster_id} starting with shards {shard_ids[0]}-{shard_ids[-1]} of {shard_count}.")
+    try:
+        bot.run(os.environ.get("TOKEN"))
+    except Exception as err:
+        print(f"Error: Cluster {cluster_id}: {err}")
+
+
+async def recommended_shards(token):
+    async with aiohttp.ClientSession() as session:
+        async with session.get("https://discord.com/api/v10/gateway/bot", headers={"Authorization": f"Bot {token}"}) as resp:
+            resp.raise_for_status()
+            return (await resp.json())["shards"]
+
+
+def split(shard_count, cluster_count):
+    # contiguous ranges, the first clusters get one extra shard when it doesn't divide evenly
+    size, extra = divmod(shard_count, cluster_count)
+    ranges = []
+    start = 0
+    for i in range(cluster_count):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return [r for r in ranges if r]
+
+
+class Hub:
+    def __init__(self, socket_path, ranges, shard_count, health_interval=60, max_pending=1000, max_accepted=10000):
+        self.socket_path = socket_path
+        self.ranges = ranges
+        self.shard_count = shard_count
+        self.health_interval = health_interval
+        self.context = multiprocessing.get_context("spawn")
+        self.processes = {}
+        self.restarts = {i: 0 for i in range(len(ranges))}
+        self.shard_clusters = {shard: cluster_id for cluster_id, shards in enumerate(ranges) for shard in shards}
+        self.writers = {}
+        # parts for clusters that are away, a full backlog refuses new parts rather than dropping ones already confirmed
+        self.pending = {i: deque() for i in range(len(ranges))}
+        self.max_pending = max_pending
+        self.full = set()
+        # release key -> clusters that got their part, so a release the leader publishes again isn't sent twice
+        self.accepted = OrderedDict()
+        self.max_accepted = max_accepted
+        self.health = {}
+        self.forwarded = 0
+        self.routed = 0
+        self.refused = 0
+
+    def spawn(self, cluster_id):
+        process = self.context.Process(target=run_cluster, args=(cluster_id, len(self.ranges), self.ranges[cluster_id], self.shard_count, self.socket_path), name=f"cluster-{cluster_id}", daemon=True)
+        process.start()
+        self.processes[cluster_id] = process
+
+    def route(self, message):
+        # one message per cluster, carrying only the subscribers that cluster delivers to
+        parts = {}
+        for entry in message["payload"]["wanted"]["servers"]:
+            cluster_id = self.shard_clusters[shard_for(entry["serverid"], self.shard_count)]
+            parts.setdefault(cluster_id, {"servers": [], "users": []})["servers"].append(entry)
+        for entry in message["payload"]["wanted"]["users"]:
+            cluster_id = user_cluster(entry["userid"], len(self.ranges))
+            parts.setdefault(cluster_id, {"servers": [], "users": []})["users"].append(entry)
+        for cluster_id, wanted in parts.items():
+            yield cluster_id, dict(message, payload=dict(message["payload"], wanted=wanted))
+
+    async def write(self, cluster_id, line):
+        writer = self.writers.get(cluster_id)
+        if writer is None:
+            return False
+        try:
+            writer.write(line)
+            await writer.drain()
+            return True
+        except ConnectionError:
+            return False
+
+    async def send(self, cluster_id, line):
+        # False when the cluster is away and its backlog is full, the leader publishes the release again next tick
+        if await self.write(cluster_id, line):
+            return True
+        pending = self.pending[cluster_id]
+        if len(pending) >= self.max_pending:
+            self.refused += 1
+            if cluster_id not in self.full:
+                self.full.add(cluster_id)
+                print(f"Error: {len(pending)} releases are waiting for cluster {cluster_id}, refusing new ones until it reconnects.")
+            return False
+        pending.append(line)
+        return True
+
+    async def forward(self, message, writer):
+        self.forwarded += 1
+        key = message["key"]
+        accepted = self.accepted.setdefault(key, set())
+        self.accepted.move_to_end(key)
+        if len(self.accepted) > self.max_accepted:
+            self.accepted.popitem(last=False)
+        ok = True
+        for target, part in self.route(message):
+            if target in accepted:
+                continue
+            if await self.send(target, json.dumps(part).encode() + b"\n"):
+                accepted.add(target)
+                self.routed += 1
+            else:
+                ok = False
+        writer.write(json.dumps({"op": "routed", "key": key, "ok": ok}).encode() + b"\n")
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        cluster_id = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if message["op"] == "hello":
+                    cluster_id = message["cluster"]
+                    self.writers[cluster_id] = writer
+                    print(f"Cluster {cluster_id} connected (pid {message['pid']}), {len(self.pending[cluster_id])} releases waiting for it.")
+                    pending = self.pending[cluster_id]
+                    while pending and await self.write(cluster_id, pending[0]):
+                        pending.popleft()
+                    self.full.discard(cluster_id)
+                elif message["op"] == "health":
+                    message["received_at"] = time.time()
+                    self.health[message["cluster"]] = message
+                elif message["op"] == "release":
+                    await self.forward(message, writer)
+        finally:
+            if cluster_id is not None and self.writers.get(cluster_id) is writer:
+                del self.writers[cluster_id]
+                print(f"Cluster {cluster_id} disconnected.")
+            writer.close()
+
+    async def monitor(self):
+        while True:
+            await asyncio.sleep(5)
+            for cluster_id, process in list(self.processes.items()):
+                if not process.is_alive():
+                    self.restarts[cluster_id] += 1
+                    delay = min(60, 5 * self.restarts[cluster_id])
+                    print(f"Error: Cluster {cluster_id} exited with code {process.exitcode}, restarting in {delay}s (restart {self.restarts[cluster_id]}).")
+                    del self.processes[cluster_id]
+                    asyncio.get_running_loop().call_later(delay, self.spawn, cluster_id)
+
+    def report(self):
+        now = time.time()
+        refused = f", {self.refused} refused" if self.refused else ""
+        lines = [f"Cluster health ({len(self.writers)}/{len(self.ranges)} connected, {self.forwarded} releases routed as {self.routed} messages{refused}):"]
+        for cluster_id, shards in enumerate(self.ranges):
+            health = self.health.get(cluster_id)
+            if health is None:
+                lines.append(f"  {cluster_id}: shards {shards[0]}-{shards[-1]}, no report yet")
+                continue
+            age = now - health["received_at"]
+            state = "ok" if health["ready"] and age < self.health_interval * 2 else "stale" if age >= self.health_interval * 2 else "starting"
+            queue = health["queue"] or {}
+            waiting = f", {len(self.pending[cluster_id])} releases waiting" if self.pending[cluster_id] else ""
+            lines.append(f"  {cluster_id}: {state}{' (rss leader)' if health['leader'] else ''}, shards {shards[0]}-{shards[-1]}, "
+                         f"{health['guilds']} guilds, latency {health['latency'] * 1000:.0f}ms, queue depth {queue.get('depth', 0)}, "
+                         f"delivered {queue.get('delivered', 0)}, dead letters {queue.get('dead_letters', 0)}, "
+                         f"restarts {self.restarts[cluster_id]}, last report {age:.0f}s ago{waiting}")
+        return "\n".join(lines)
+
+    async def run(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle, self.socket_path, limit=LINE_LIMIT)
+        for cluster_id in range(len(self.ranges)):
+            self.spawn(cluster_id)
+        monitor = asyncio.create_task(self.monitor())
+        try:
+            while True:
+                await asyncio.sleep(self.health_interval)
+                print(self.report())
+        finally:
+            monitor.cancel()
+            server.close()
+            for process in self.processes.values():
+                process.terminate()
+
+
+async def main(args):
+    shard_count = args.shards or int(os.environ.get("SHARD_COUNT", 0)) or await recommended_shards(os.environ.get("TOKEN"))
+    clusters = min(args.clusters or int(os.environ.get("CLUSTER_COUNT", 0)) or os.cpu_count() or 1, shard_count)
+    ranges = split(shard_count, clusters)
+    print(f"Starting {len(ranges)} clusters for {shard_count} shards.")
+    await Hub(args.socket, ranges, shard_count).run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clusters", type=int, default=None, help="worker processes, defaults to CLUSTER_COUNT or the number of cpus")
+    parser.add_argument("--shards", type=int, default=None, help="total shards, defaults to SHARD_COUNT or discord's recommendation")
+    parser.add_argument("--socket", default=os.environ.get("CLUSTER_SOCKET_PATH", "/tmp/mangaupdates-cluster.sock"))
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
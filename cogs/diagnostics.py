@@ -0,0 +1,41 @@
+import discord
+from discord.ext import commands
+from discord.commands import Option, SlashCommandGroup
+from datetime import datetime
+
+
+class Diagnostics(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    diagnostics = SlashCommandGroup(name="diagnostics", description="Bot owner diagnostics")
+
+    @diagnostics.command(name="lag", description="Shows the code that blocked the event loop the longest")
+    @commands.is_owner()
+    async def lag(self, ctx, count: Option(int, "Number of call sites", required=False, default=5, min_value=1, max_value=10), reset: Option(bool, "Clear the table afterwards", required=False, default=False)):
+        watchdog = self.bot.services.watchdog
+        if watchdog is None:
+            notRunning = discord.Embed(title="Error", color=0xff4f4f, description="The loop watchdog isn't running.")
+            await ctx.respond(embed=notRunning, ephemeral=True)
+            return
+        stats = watchdog.stats()
+        embed = discord.Embed(title="Event Loop Stalls", color=0x3083e3,
+            description=f"{stats['stalls']} stalls over {watchdog.threshold * 1000:.0f}ms since <t:{int(watchdog.started)}:R>, worst {stats['max_lag'] * 1000:.0f}ms.")
+        for offender in watchdog.top(count):
+            summary = f"{offender['count']} stalls, {offender['total']:.2f}s total, worst {offender['max'] * 1000:.0f}ms, last <t:{int(offender['last'])}:R>"
+            stack = offender["stack"] or "no stack captured"
+            # field values are capped at 1024 characters, keep the innermost frames
+            room = 1024 - len(summary) - 10
+            if len(stack) > room:
+                stack = "…" + stack[-(room - 1):]
+            embed.add_field(name=offender["site"][:256], value=f"{summary}\n```{stack}```", inline=False)
+        if not watchdog.offenders:
+            embed.add_field(name="No stalls", value="Nothing has blocked the loop past the threshold.", inline=False)
+        embed.set_footer(text=datetime.now().strftime("%H:%M:%S"))
+        await ctx.respond(embed=embed, ephemeral=True)
+        if reset:
+            watchdog.offenders.clear()
+
+
+def setup(bot):
+    bot.add_cog(Diagnostics(bot))
@@ -1,14 +1,11 @@
 import discord
 from discord.ext import commands
 from discord.commands import Option, slash_command, SlashCommandGroup
+from core.context import AccountContext
 import validators
 import os
-from core.mongodb import Mongo
-from core.mangaupdates import MangaUpdates
 
 
-mongo = Mongo()
-mangaupdates = MangaUpdates()
 ghuser = os.environ.get("GITHUB_USER")
 
 timeoutError = discord.Embed(title="Error", description="You didn't respond in time! Please rerun the command.", color=0xff4f4f)
@@ -58,14 +55,18 @@ async def is_admin(ctx):
     return has_add_permission
 
 async def is_server_exists(ctx):
-    server_exists = await mongo.check_server_exist(ctx.guild.id)
-    if not server_exists:
+    # returns the loaded server context (or None) so callers can keep reading from the same document
+    account = await AccountContext(ctx.bot.services.mongo, "server", ctx.guild.id, ctx.command.qualified_name).load()
+    if not account.exists():
         setupError = discord.Embed(title="Error", color=0xff4f4f, description="Sorry! Please run the setup command first.")
         await ctx.respond(embed=setupError, view=None)
-    return server_exists
+        return None
+    return account
 
 async def validate_admin_and_server(ctx):
-    return await is_admin(ctx) and await is_server_exists(ctx)
+    if not await is_admin(ctx):
+        return None
+    return await is_server_exists(ctx)
 
 class MangaGeneral(commands.Cog):
     def __init__(self, bot):
@@ -75,25 +76,27 @@ class MangaGeneral(commands.Cog):
 
     @server.command(name="setup", description="Sets up your server for updates")
     async def setup(self, ctx, channel: Option(discord.TextChannel, required=True)):
-        serverExist = await mongo.check_server_exist(ctx.guild.id)
-        if serverExist is True:
-            alrfinishSS = discord.Embed(title="Setup", color=0x3083e3, description="This server is already setup.")
-            await ctx.respond(embed=alrfinishSS, view=None)
-            return
+        mongo = self.bot.services.mongo
         if ctx.author.guild_permissions.administrator is False:
             permissionError = discord.Embed(title="Error", color=0xff4f4f, description="You don't have permission to setup this server's account. You need `Administrator` permission to use this.")
             await ctx.respond(embed=permissionError, view=None)
             return
         channelid = channel.id
-        await mongo.add_server(ctx.guild.name, ctx.guild.id, channelid)
+        # the insert itself tells us whether the server was already set up, no separate lookup
+        created = await mongo.add_server(ctx.guild.name, ctx.guild.id, channelid)
+        if created is False:
+            alrfinishSS = discord.Embed(title="Setup", color=0x3083e3, description="This server is already setup.")
+            await ctx.respond(embed=alrfinishSS, view=None)
+            return
         embedServerF = discord.Embed(title="Setup", color=0x3083e3, description="Great! You're all set up and can add manga now.")
         await ctx.respond(embed=embedServerF, view=None)
 
     @server.command(name="setchannel", description="Sets the server's channel that updates are sent to")
     async def setchannel(self, ctx, channel: Option(discord.TextChannel, required=True)):
+        mongo = self.bot.services.mongo
         setupError = discord.Embed(title="Error", color=0xff4f4f, description="Sorry! Please run the setup command first.")
-        serverExist = await mongo.check_server_exist(ctx.guild.id)
-        if serverExist is False:
+        account = await AccountContext(mongo, "server", ctx.guild.id, ctx.command.qualified_name).load()
+        if account.exists() is False:
             await ctx.respond(embed=setupError, view=None)
             return
         if ctx.author.guild_permissions.administrator is False:
@@ -101,7 +104,7 @@ class MangaGeneral(commands.Cog):
             await ctx.respond(embed=permissionError, view=None)
             return
         channelid = channel.id
-        curchannel = await mongo.get_channel(ctx.guild.id)
+        curchannel = account.channel()
         if channelid == curchannel:
             sameError = discord.Embed(title="Error", color=0xff4f4f, description="This channel is already set as the channel for manga updates.")
             await ctx.respond(embed=sameError, view=None)
@@ -112,6 +115,7 @@ class MangaGeneral(commands.Cog):
 
     @server.command(name="delete", description="Deletes your server's account and list")
     async def delete(self, ctx):
+        mongo = self.bot.services.mongo
         setupError = discord.Embed(title="Error", color=0xff4f4f, description="Sorry! Please run the setup command first.")
         serverExist = await mongo.check_server_exist(ctx.guild.id)
         if serverExist is False:
@@ -139,10 +143,11 @@ class MangaGeneral(commands.Cog):
 
     @server.command(name="addadminrole", description="Sets a role that can modify the manga list")
     async def add_admin_role(self, ctx, role: Option(discord.Role, required=True)):
-        hasPermission = await validate_admin_and_server(ctx)
-        if not hasPermission:
+        mongo = self.bot.services.mongo
+        account = await validate_admin_and_server(ctx)
+        if not account:
             return
-        curRole = await mongo.get_admin_role_server(ctx.guild.id)
+        curRole = account.admin_role()
         if curRole == role.id:
             sameError = discord.Embed(title="Error", color=0xff4f4f, description="This role is already set as the admin role.")
             await ctx.respond(embed=sameError, view=None)
@@ -153,6 +158,7 @@ class MangaGeneral(commands.Cog):
 
     @server.command(name="removeadminrole", description="Removes the role that can modify the manga list")
     async def remove_admin_role(self, ctx):
+        mongo = self.bot.services.mongo
         hasPermission = await validate_admin_and_server(ctx)
         if not hasPermission:
             return
@@ -174,16 +180,15 @@ class MangaGeneral(commands.Cog):
 
     @server.command(name="test", description="Tests sending updates to your server")
     async def testsending(self, ctx):
-        channel = await mongo.get_channel(ctx.guild.id)
+        mongo = self.bot.services.mongo
+        account = await AccountContext(mongo, "server", ctx.guild.id, ctx.command.qualified_name).load()
+        channel = account.channel()
         if channel is None:
             noChannelError = discord.Embed(title="Error", color=0xff4f4f, description="You have no channel set up. Please set one up with the `setup` command.")
             await ctx.respond(embed=noChannelError, view=None)
             return
         else:
-            hasPermission = False
-            adminRole = await mongo.get_admin_role_server(ctx.guild.id)
-            authorRoles = [r.id for r in ctx.author.roles]
-            hasPermission = ctx.author.guild_permissions.administrator or (adminRole in authorRoles)
+            hasPermission = account.is_admin(ctx.author)
             if not hasPermission:
                 permissionError = discord.Embed(title="Error", color=0xff4f4f, description=("You don't have permission to test alerts. Set a role to modify manga with `/server addadminrole` or have `Administrator` permission."))
                 await ctx.respond(embed=permissionError, view=None)
@@ -201,7 +206,7 @@ class MangaGeneral(commands.Cog):
                     mangaTestEmbed.add_field(name="Chapter", value="c.1", inline=True)
                     mangaTestEmbed.add_field(name="Group", value="The MangaUpdates Bot Team", inline=True)
                     mangaTestEmbed.add_field(name="Scanlator Link", value="https://hayasaka.moe/", inline=False)
-                    await channelObject.send(embed=mangaTestEmbed, view=None)
+                    await self.bot.outbound.send("interaction", channelObject, embed=mangaTestEmbed, view=None)
                     mainResponseEmbed = discord.Embed(title="Test Manga Update Message", color=0x3083e3, description="Congrats! Manga can be sent to your server.")
                     await ctx.respond(embed=mainResponseEmbed, view=None)
                 except:
@@ -213,18 +218,19 @@ class MangaGeneral(commands.Cog):
 
     @user.command(name="setup", description="Sets up your user for updates")
     async def setup(self, ctx):
-        userExist = await mongo.check_user_exist(ctx.author.id)
-        if userExist is True:
+        mongo = self.bot.services.mongo
+        username = f"{ctx.author.name}#{ctx.author.discriminator}"
+        created = await mongo.add_user(username, ctx.author.id)
+        if created is False:
             alrfinishUS = discord.Embed(title="Setup", color=0x3083e3, description="You are already setup.")
             await ctx.respond(embed=alrfinishUS, view=None)
             return
-        username = f"{ctx.author.name}#{ctx.author.discriminator}"
-        await mongo.add_user(username, ctx.author.id)
         embedUser = discord.Embed(title="Setup", color=0x3083e3, description="Great! You're all set up and can add manga now.")
         await ctx.respond(embed=embedUser, view=None)
     
     @user.command(name="delete", description="Deletes your user account and list")
     async def delete(self, ctx):
+        mongo = self.bot.services.mongo
         setupError = discord.Embed(title="Error", color=0xff4f4f, description="Sorry! Please run the setup command first.")
         userExist = await mongo.check_user_exist(ctx.author.id)
         if userExist is False:
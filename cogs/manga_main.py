@@ -2,14 +2,11 @@ import os
 import discord
 from discord.ext import commands, pages
 from discord.commands import Option, SlashCommandGroup
-from core.mongodb import Mongo
-from core.mangaupdates import MangaUpdates
 from core.utils import Util
 from core.manga_util import SearchData
+from core.context import AccountContext
 import validators
 
-mangaupdates = MangaUpdates()
-mongo = Mongo()
 util = Util()
 
 timeoutError = discord.Embed(title="Error", description="You didn't respond in time! Please rerun the command.", color=0xff4f4f)
@@ -73,6 +70,7 @@ class SelectMangaSearch(discord.ui.Select):
         self.finish = None
 
     async def callback(self, interaction: discord.Interaction):
+        mangaupdates = interaction.client.services.mangaupdates
         value = int(self.values[0][:2].replace(".", "")) - 1
         mangaid = self.manga_list[value]["id"]
         series_info = await mangaupdates.series_info(mangaid)
@@ -114,6 +112,7 @@ class SelectMangaAddWConfirm(discord.ui.Select):
         self.modeval = mode
 
     async def callback(self, interaction: discord.Interaction):
+        mongo = interaction.client.services.mongo
         value = int(self.values[0][:2].replace(".", "")) - 1
         title = self.manga_list[value]["info"]["title"]
         fulldescription = self.manga_list[value]["info"]["description"]
@@ -172,6 +171,8 @@ class SelectMangaRemove(discord.ui.Select):
         self.modeval = mode
 
     async def callback(self, interaction: discord.Interaction):
+        mongo = interaction.client.services.mongo
+        mangaupdates = interaction.client.services.mangaupdates
         value = int(self.values[0][:2].replace(".", "")) - 1
         if value > 25:
             value = value - 25
@@ -224,6 +225,7 @@ class SelectMangaSetGroup(discord.ui.Select):
         self.modeval = mode
 
     async def callback(self, interaction: discord.Interaction):
+        mangaupdates = interaction.client.services.mangaupdates
         value = int(self.values[0][:2].replace(".", "")) - 1
         if value > 25:
             value = value - 25
@@ -271,6 +273,7 @@ class SelectScanGroup(discord.ui.Select):
         self.modeval = mode
 
     async def callback(self, interaction: discord.Interaction):
+        mongo = interaction.client.services.mongo
         value = int(self.values[0][:2].replace(".", "")) - 1
         name = self.group_list[value]["name"]
         mangaTitle = self.group_list[value]["mangaTitle"]
@@ -304,12 +307,13 @@ class MangaMain(commands.Cog):
 
     @manga.command(name="search", description="Searches for a manga series")
     async def search(self, ctx, manga: Option(str, description="The name of the manga series (can use mangaupdates links)", required=True)):
+        mangaupdates = self.bot.services.mangaupdates
         if validators.url(manga) is True:
-            if manga.partition("https://www.mangaupdates.com/series.html?id=")[2] != "":
-                manga = await mangaupdates.getCanonical(manga)
-            link = manga.partition("https://www.mangaupdates.com/series/")[2]
-            mangaid = link.partition("/")[0]
-            mangaid = await mangaupdates.convert_new_id(mangaid)
+            mangaid = await mangaupdates.series_id_from_link(manga)
+            if mangaid is None:
+                resultError = discord.Embed(title="Error", color=0xff4f4f, description="No mangas were found.")
+                await ctx.respond(embed=resultError)
+                return
             series_info = await mangaupdates.series_info(mangaid)
             data = SearchData(series_info)
             result = discord.Embed(title=f"{data.title} ({data.status})", url=data.url, color=0x3083e3, description=data.description)
@@ -363,6 +367,8 @@ class MangaMain(commands.Cog):
 
     @manga.command(name="add", description="Adds manga to your list to be tracked")
     async def add(self, ctx, manga: Option(str, description="The name of the manga series (can use mangaupdates links)", required=True)):
+        mongo = self.bot.services.mongo
+        mangaupdates = self.bot.services.mangaupdates
         if ctx.guild is not None:
             modeEmbed = discord.Embed(title="Add Manga", color=0x3083e3, description="Do you want this manga added to your list or this server's list?")
             mode = Mode()
@@ -379,26 +385,23 @@ class MangaMain(commands.Cog):
         setupError = discord.Embed(title="Error", color=0xff4f4f, description="Sorry! Please run the setup command first.")
 
         if modeval == "user":
-            userExist = await mongo.check_user_exist(ctx.author.id)
-            if userExist is False:
+            account = await AccountContext(mongo, "user", ctx.author.id, ctx.command.qualified_name).load()
+            if account.exists() is False:
                 if mode is not None:
                     await mode.interaction.response.edit_message(embed=setupError, view=None)
                 else:
                     await ctx.respond(embed=setupError, view=None)
                 return
         elif modeval == "server":
-            serverExist = await mongo.check_server_exist(ctx.guild.id)
-            if serverExist is False:
+            account = await AccountContext(mongo, "server", ctx.guild.id, ctx.command.qualified_name).load()
+            if account.exists() is False:
                 if mode is not None:
                     await mode.interaction.response.edit_message(embed=setupError, view=None)
                 else:
                     await ctx.respond(embed=setupError, view=None)
                 return
             else:
-                hasPermission = False
-                adminRole = await mongo.get_admin_role_server(ctx.guild.id)
-                authorRoles = [r.id for r in ctx.author.roles]
-                hasPermission = ctx.author.guild_permissions.administrator or (adminRole in authorRoles)
+                hasPermission = account.is_admin(ctx.author)
                 if not hasPermission:
                     permissionError = discord.Embed(title="Error", color=0xff4f4f, description=("You don't have permission to add manga. Set a role to modify manga with `/server addadminrole` or have `Administrator` permission."))
                     if mode is not None:
@@ -407,17 +410,17 @@ class MangaMain(commands.Cog):
                         await ctx.respond(embed=permissionError, view=None)
                     return
         if validators.url(manga) is True:
-            if manga.partition("https://www.mangaupdates.com/series.html?id=")[2] != "":
-                manga = await mangaupdates.getCanonical(manga)
-            link = manga.partition("https://www.mangaupdates.com/series/")[2]
-            mangaid = link.partition("/")[0]
-            mangaid = await mangaupdates.convert_new_id(mangaid)
+            mangaid = await mangaupdates.series_id_from_link(manga)
+            if mangaid is None:
+                resultError = discord.Embed(title="Error", color=0xff4f4f, description="No mangas were found.")
+                if mode is not None:
+                    await mode.interaction.response.edit_message(embed=resultError, view=None)
+                else:
+                    await ctx.respond(embed=resultError, view=None)
+                return
             series_info = await mangaupdates.series_info(mangaid)
             manganame = series_info["title"]
-            if modeval == "user":
-                mangaindb = await mongo.check_manga_exist_user(ctx.author.id, mangaid)
-            elif modeval == "server":
-                mangaindb = await mongo.check_manga_exist_server(ctx.guild.id, mangaid)
+            mangaindb = account.has_manga(mangaid)
             if mangaindb is True:
                 mangaExist = discord.Embed(title="Add Manga", color=0x3083e3, description="This manga is already added to your list.")
                 if mode is not None:
@@ -477,6 +480,7 @@ class MangaMain(commands.Cog):
         
     @manga.command(name="remove", description="Removes a manga series from your list")
     async def remove(self, ctx):
+        mongo = self.bot.services.mongo
         if ctx.guild is not None:
             modeEmbed = discord.Embed(title="Remove Manga", color=0x3083e3, description="Do you want to remove a manga from your list or this server's list?")
             mode = Mode()
@@ -494,27 +498,24 @@ class MangaMain(commands.Cog):
         setupError = discord.Embed(title="Error", color=0xff4f4f, description="Sorry! Please run the setup command first.")
         noManga = discord.Embed(title="Error", color=0xff4f4f, description="You have no manga added to your list. Please add some manga first.")
         if modeval == "user":
-            userExist = await mongo.check_user_exist(ctx.author.id)
-            if userExist is False:
+            account = await AccountContext(mongo, "user", ctx.author.id, ctx.command.qualified_name).load()
+            if account.exists() is False:
                 if mode is not None:
                     await mode.interaction.edit_original_message(embed=setupError, view=None)
                 else:
                     await ctx.respond(embed=setupError, view=None)
                 return
-            mangaList = await mongo.get_manga_list_user(ctx.author.id)
+            mangaList = account.manga_list()
         elif modeval == "server":
-            serverExist = await mongo.check_server_exist(ctx.guild.id)
-            if serverExist is False:
+            account = await AccountContext(mongo, "server", ctx.guild.id, ctx.command.qualified_name).load()
+            if account.exists() is False:
                 if mode is not None:
                     await mode.interaction.edit_original_message(embed=setupError, view=None)
                 else:
                     await ctx.respond(embed=setupError, view=None)
                 return
             else:
-                hasPermission = False
-                adminRole = await mongo.get_admin_role_server(ctx.guild.id)
-                authorRoles = [r.id for r in ctx.author.roles]
-                hasPermission = ctx.author.guild_permissions.administrator or (adminRole in authorRoles)
+                hasPermission = account.is_admin(ctx.author)
                 if not hasPermission:
                     permissionError = discord.Embed(title="Error", color=0xff4f4f, description=("You don't have permission to remove manga. Set a role to modify manga with `/server addadminrole` or have `Administrator` permission."))
                     if mode is not None:
@@ -522,7 +523,7 @@ class MangaMain(commands.Cog):
                     else:
                         await ctx.respond(embed=permissionError, view=None)
                     return
-                mangaList = await mongo.get_manga_list_server(ctx.guild.id)
+                mangaList = account.manga_list()
         if mangaList is None:
             if mode is not None:
                 await mode.interaction.edit_original_message(embed=noManga, view=None)
@@ -583,6 +584,7 @@ class MangaMain(commands.Cog):
 
     @manga.command(name="list", description="Lists all manga in your list")
     async def list(self, ctx):
+        mongo = self.bot.services.mongo
         if ctx.guild is not None:
             modeEmbed = discord.Embed(title="Manga List", color=0x3083e3, description="Do you want to see your manga list or this server's manga list?")
             mode = Mode()
@@ -599,8 +601,8 @@ class MangaMain(commands.Cog):
             mode = None
         setupError = discord.Embed(title="Error", color=0xff4f4f, description="Sorry! Please run the setup command first.")
         if modeval == "user":
-            userExist = await mongo.check_user_exist(ctx.author.id)
-            if userExist is False:
+            account = await AccountContext(mongo, "user", ctx.author.id, ctx.command.qualified_name).load()
+            if account.exists() is False:
                 if mode is not None:
                     await mode.interaction.edit_original_message(embed=setupError, view=None)
                 else:
@@ -608,10 +610,10 @@ class MangaMain(commands.Cog):
                 return
             name = ctx.author.name
             icon = ctx.author.display_avatar
-            mangaList = await mongo.get_manga_list_user(ctx.author.id)
+            mangaList = account.manga_list()
         elif modeval == "server":
-            serverExist = await mongo.check_server_exist(ctx.guild.id)
-            if serverExist is False:
+            account = await AccountContext(mongo, "server", ctx.guild.id, ctx.command.qualified_name).load()
+            if account.exists() is False:
                 if mode is not None:
                     await mode.interaction.edit_original_message(embed=setupError, view=None)
                 else:
@@ -622,7 +624,7 @@ class MangaMain(commands.Cog):
                 icon = ctx.guild.icon.url
             else:
                 icon = "https://cdn.discordapp.com/embed/avatars/0.png"
-            mangaList = await mongo.get_manga_list_server(ctx.guild.id)
+            mangaList = account.manga_list()
         if mangaList is None:
             description = "You have no manga added to your list."
             mangaListEmbed = discord.Embed(title=f"{name}'s Manga List", color=0x3083e3, description=description)
@@ -663,6 +665,7 @@ class MangaMain(commands.Cog):
 
     @manga.command(name="setgroup", description="Sets a manga's scan group")
     async def setgroup(self, ctx):
+        mongo = self.bot.services.mongo
         if ctx.guild is not None:
             modeEmbed = discord.Embed(title="Set Scanlator Group", color=0x3083e3, description="Do you want to set your manga's scan groups or the server's scan groups?")
             mode = Mode()
@@ -680,27 +683,24 @@ class MangaMain(commands.Cog):
         setupError = discord.Embed(title="Error", color=0xff4f4f, description="Sorry! Please run the setup command first.")
         noManga = discord.Embed(title="Error", color=0xff4f4f, description="You have no manga added to your list. Please add some manga first.")
         if modeval == "user":
-            userExist = await mongo.check_user_exist(ctx.author.id)
-            if userExist is False:
+            account = await AccountContext(mongo, "user", ctx.author.id, ctx.command.qualified_name).load()
+            if account.exists() is False:
                 if mode is not None:
                     await mode.interaction.edit_original_message(embed=setupError, view=None)
                 else:
                     await ctx.respond(embed=setupError, view=None)
                 return
-            mangaList = await mongo.get_manga_list_user(ctx.author.id)
+            mangaList = account.manga_list()
         elif modeval == "server":
-            serverExist = await mongo.check_server_exist(ctx.guild.id)
-            if serverExist is False:
+            account = await AccountContext(mongo, "server", ctx.guild.id, ctx.command.qualified_name).load()
+            if account.exists() is False:
                 if mode is not None:
                     await mode.interaction.edit_original_message(embed=setupError, view=None)
                 else:
                     await ctx.respond(embed=setupError, view=None)
                 return
             else:
-                hasPermission = False
-                adminRole = await mongo.get_admin_role_server(ctx.guild.id)
-                authorRoles = [r.id for r in ctx.author.roles]
-                hasPermission = ctx.author.guild_permissions.administrator or (adminRole in authorRoles)
+                hasPermission = account.is_admin(ctx.author)
                 if not hasPermission:
                     permissionError = discord.Embed(title="Error", color=0xff4f4f, description=("You don't have permission to set a manga's scan groups. Set a role to modify manga with `/server addadminrole` or have `Administrator` permission."))
                     if mode is not None:
@@ -708,7 +708,7 @@ class MangaMain(commands.Cog):
                     else:
                         await ctx.respond(embed=permissionError, view=None)
                     return
-                mangaList = await mongo.get_manga_list_server(ctx.guild.id)
+                mangaList = account.manga_list()
         if mangaList is None:
             if mode is not None:
                 await mode.interaction.edit_original_message(embed=noManga, view=None)
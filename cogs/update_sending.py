@@ -2,108 +2,174 @@ import discord
 from discord.ext import commands, tasks
 import asyncio
 from datetime import datetime
-from core.mongodb import Mongo
-from core.rss import RSSParser
 import traceback
-import json
-import re
-from core.mangaupdates import MangaUpdates
+import os
+from core.delivery import DeliveryEngine, DMChannels
+from core.jobs import ReleaseQueue
+from core.mongodb import Mongo
+from core.metrics import TICK_SECONDS, TICK_RELEASES
 
-mongo = Mongo()
-mangaupdates = MangaUpdates()
-rss = RSSParser()
 
 class UpdateSending(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.old = None
+        # fingerprints of the previous feed only, so memory stays bounded by the feed size
+        self.seen = set()
+        self.delivery = DeliveryEngine(bot.outbound, concurrency=int(os.environ.get("DELIVERY_CONCURRENCY", 10)))
+        self.jobs = None
+        self.dms = None
         self.check_for_updates.start()
 
     def cog_unload(self):
         self.check_for_updates.cancel()
+        if self.jobs is not None:
+            asyncio.create_task(self.jobs.stop())
 
-    # todo: setup failsafe by saving last data to somewhere to check again if bot dies and needs to restart (redis maybe?)
     @tasks.loop(seconds=15)
     async def check_for_updates(self):
-        errorChannel = self.bot.get_channel(990005048408936529)
-        new = await rss.parse_feed()
+        rss = self.bot.services.rss
+        mongo = self.bot.services.mongo
+        series = self.bot.services.series
+        cluster = self.bot.services.cluster
+        lease = self.bot.services.lease
+        # everything logged since the last tick (deliveries included) goes out as one digest
+        self.bot.ops.flush()
+        if lease is not None and not await lease.acquire():
+            # another cluster is polling, start over from the ledger if this one takes over later
+            self.old = None
+            self.seen = set()
+            return
+        with TICK_SECONDS.time(stage="feed"):
+            new = await rss.parse_feed()
         print("Checking for new updates! " + (str(datetime.now().strftime("%H:%M:%S"))))
+        if new is not None and new is self.old:
+            # feed hasn't changed since the last tick (304), nothing to diff
+            return
         try:
-            tempNew = set(json.dumps(x, sort_keys=True) for x in new)
-            # print("new: " + str(tempNew)[:1000])
-            tempOld = set(json.dumps(x, sort_keys=True) for x in self.old)
-            # print("old: " + str(tempOld)[:1000])
-            new_mangas = [json.loads(x) for x in (tempNew - tempOld)]
-            # print("before: " + str(new_mangas))
+            current = {x.key: x for x in new}
+            # releases the hub couldn't take, left out of the ledger and self.seen so the next tick publishes them again
+            unrouted = set()
+            candidates = [key for key in current if key not in self.seen]
+            # the ledger decides what is actually new, so releases published while the bot was down are sent once after restart
+            with TICK_SECONDS.time(stage="ledger"):
+                new_mangas = await mongo.unseen_releases(candidates) if candidates else []
+            TICK_RELEASES.observe(len(new_mangas))
             if new_mangas != []:
-                print("New update found!")
-                await errorChannel.send("New update found!")
-                # print("after: " + str(new_mangas))
-                for manga in new_mangas:
-                    await self.notify(manga["title"], manga["chapter"], manga["scan_group"], manga["link"])
-            self.old = new
+                # polling only enqueues, the consumers mark a release seen once it has been delivered
+                releases = [current[key] for key in new_mangas]
+                # series metadata for the whole tick is refreshed in bulk, notify reads the cover from it
+                with TICK_SECONDS.time(stage="series"):
+                    await series.refresh([release.series_id() for release in releases])
+                    await series.resolve_titles([release.title for release in releases if release.series_id() is None])
+                lookups = {release.key: self.lookup(release) for release in releases}
+                # subscribers for the whole tick come from one query per collection, groups are filtered per release later
+                with TICK_SECONDS.time(stage="wanted"):
+                    wanted = await mongo.manga_wanted_batch(list(set(lookups.values())))
+                    if cluster is None:
+                        # stored dm channels for every user in the tick, clusters load their own share in notify
+                        await self.dms.preload([user["userid"] for entries in wanted.values() for user in entries["users"]])
+                with TICK_SECONDS.time(stage="enqueue"):
+                    for release in releases:
+                        mangaid = lookups[release.key][0]
+                        payload = {"wanted": wanted[lookups[release.key]], "series": series.get(mangaid)}
+                        if cluster is not None:
+                            if not await cluster.publish(release, payload):
+                                unrouted.add(release.key)
+                        else:
+                            await self.jobs.put(release, payload)
+                    if cluster is not None:
+                        # handed off to the clusters that own the subscribers, none of them marks it seen
+                        await mongo.mark_releases_seen([key for key in new_mangas if key not in unrouted])
+                stats = self.jobs.stats()
+                print(f"New update found! ({len(new_mangas)} new, queue depth {stats['depth']})")
+                self.bot.ops.event("tick", new=len(new_mangas), depth=stats["depth"], dead_letters=stats["dead_letters"])
+            self.seen = set(current) - unrouted
+            # an unchanged feed skips the diff, which would never retry them
+            self.old = new if not unrouted else None
         except:
             print("Error: " + traceback.format_exc())
-            await errorChannel.send("Error: There was an error with the update check.")
+            self.bot.ops.event("error", message="There was an error with the update check.", traceback=traceback.format_exc())
             pass
         
     
     @check_for_updates.before_loop
     async def before_printer(self):
-        self.old = await rss.parse_feed()
+        # services are started by the bot before it logs in, so wait for that first
         await self.bot.wait_until_ready()
+        rss = self.bot.services.rss
+        mongo = self.bot.services.mongo
+        cluster = self.bot.services.cluster
+        # persisted jobs are keyed by release alone, clusters would overwrite each other's
+        store = mongo if os.environ.get("PERSISTENT_QUEUE") == "1" and cluster is None else None
+        self.dms = DMChannels(self.bot, mongo, self.bot.outbound)
+        self.jobs = ReleaseQueue(self.deliver_release, consumers=int(os.environ.get("DELIVERY_CONSUMERS", 2)), on_dead_letter=self.dead_letter, store=store)
+        await self.jobs.start()
+        if cluster is not None:
+            cluster.set_handler(self.receive_release)
+        if await mongo.release_ledger_empty():
+            # first run against an empty ledger, record the current feed instead of announcing all of it
+            self.old = await rss.parse_feed()
+            if self.old:
+                self.seen = set(x.key for x in self.old)
+                await mongo.mark_releases_seen(list(self.seen))
+
+    def lookup(self, release):
+        mangaid = release.series_id()
+        if mangaid is None:
+            mangaid = self.bot.services.series.id_for_title(release.title)
+        return (mangaid, None) if mangaid is not None else (None, release.title)
+
+    async def receive_release(self, release, payload):
+        # routed here by the hub, the wanted lists only hold this cluster's guilds and users
+        await self.jobs.put(release, payload)
+
+    async def deliver_release(self, release, payload=None):
+        payload = payload or {}
+        await self.notify(release.title, release.chapter, release.scan_group, release.link, payload.get("wanted"), payload.get("series"))
+        if self.bot.services.cluster is None:
+            await self.bot.services.mongo.mark_releases_seen([release.key])
+
+    async def dead_letter(self, release, error):
+        # give up on it for good, otherwise the next restart would replay it from the ledger
+        await self.bot.services.mongo.mark_releases_seen([release.key])
+        self.bot.ops.event("dead_letter", title=release.title, link=release.link, error=error)
 
-    async def notify(self, title, chapter, scan_group, link):
-        errorChannel = self.bot.get_channel(990005048408936529)
+    async def notify(self, title, chapter, scan_group, link, wanted=None, series=None):
+        mongo = self.bot.services.mongo
+        mangaupdates = self.bot.services.mangaupdates
         print(f"Notifying! ({title})")
-        if link:
-            urlmangaid = re.search("(?<=series/).+?(?=/)", link).group()
-            mangaid = await mangaupdates.convert_new_id(urlmangaid)
-            data = await mangaupdates.series_info(mangaid)
-            image = data["image"]["url"]["original"]
+        if series is not None:
+            mangaid = series["id"]
+            image = series["image"]
         else:
+            mangaid = await mangaupdates.series_id_from_link(link) if link else None
             image = None
+            if mangaid is not None:
+                data = await mangaupdates.series_info(mangaid)
+                image = data["image"]["url"]["original"]
 
-        if scan_group:
-            if "&" in scan_group:
-                group = scan_group.split("&")
-                group = [x.strip(' ') for x in scan_group]
-            else:
-                group = [scan_group]
-            sgs = []
-            for g in group:
-                scan_groups_search = await mangaupdates.search_groups(scan_group)
-                scan_group_results = scan_groups_search["results"][0]
-                sgs.append(scan_group_results["record"])
-
-        if link:
+        # collaborations are split on "&" and resolved from the local group index in one pass
+        sgs = await self.bot.services.groups.resolve(scan_group)
+
+        if wanted is not None:
+            serverWant = Mongo.filter_wanted(wanted["servers"], sgs)
+            userWant = Mongo.filter_wanted(wanted["users"], sgs)
+        elif mangaid is not None:
             serverWant = await mongo.manga_wanted_server(sgs, manga_id=mangaid)
             userWant = await mongo.manga_wanted_user(sgs, manga_id=mangaid)
         else:
             serverWant = await mongo.manga_wanted_server(sgs, manga_title=title)
             userWant = await mongo.manga_wanted_user(sgs, manga_title=title)
 
-        if serverWant:
-            channelidsthatwant = []
-            for server in serverWant:
-                channelidsthatwant.append(server["channelid"])
-            serverstosend = f"Some servers want {title}!"
-        else:
-            serverstosend = f"No servers want this {title}"
-        if userWant:
-            useridsthatwant = []
-            for user in userWant:
-                useridsthatwant.append(user["userid"])
-            userstosend = f"Some users want {title}!"
-        else:
-            userstosend = f"No users want this {title}"
-        await errorChannel.send(serverstosend)
-        await errorChannel.send(userstosend)
-        
+        self.bot.ops.event("wanted", title=title, servers=len(serverWant or []), users=len(userWant or []))
+
         if userWant or serverWant:
             print(f"Manga Wanted ({title})")
             
-            if sgs[0]["social"]["site"]:
+            if not sgs:
+                scanLink = "N/A"
+            elif sgs[0]["social"]["site"]:
                 scanLink = sgs[0]["social"]["site"]
             elif sgs[0]["social"]["discord"]:
                 scanLink = sgs[0]["social"]["discord"]
@@ -112,56 +178,53 @@ class UpdateSending(commands.Cog):
             else:
                 scanLink = sgs[0]["url"]
         
+        # subscribers share an embed per stored title, it is built once per release rather than per recipient
+        embeds = {}
+        def build_embed(manga_title):
+            if manga_title not in embeds:
+                embed = discord.Embed(title=f"New {manga_title} chapter released!", url=link, description=f"There is a new `{manga_title}` chapter.", color=0x3083e3)
+                embed.set_author(name="MangaUpdates", icon_url=self.bot.user.avatar.url)
+                embed.add_field(name="Chapter", value=chapter, inline=True)
+                embed.add_field(name="Group", value=scan_group, inline=True)
+                embed.add_field(name="Scanlator Link", value=scanLink, inline=False)
+                if image != None:
+                    embed.set_image(url=image)
+                embeds[manga_title] = embed
+            return embeds[manga_title]
+
+        def send_user(user):
+            async def send():
+                await self.dms.send(user["userid"], embed=build_embed(user["title"]))
+            return send
+
+        def send_channel(server):
+            async def send():
+                channelObject = self.bot.get_channel(server["channelid"])
+                await channelObject.send(embed=build_embed(server["title"]))
+            return send
+
+        jobs = []
         if userWant:
             for user in userWant:
-                try:
-                    userObject = await self.bot.fetch_user(user["userid"])
-                    userEmbed = discord.Embed(title=f"New {user['title']} chapter released!", url=link, description=f"There is a new `{user['title']}` chapter.", color=0x3083e3)
-                    userEmbed.set_author(name="MangaUpdates", icon_url=self.bot.user.avatar.url)
-                    userEmbed.add_field(name="Chapter", value=chapter, inline=True)
-                    userEmbed.add_field(name="Group", value=scan_group, inline=True)
-                    userEmbed.add_field(name="Scanlator Link", value=scanLink, inline=False)
-                    if image != None:
-                        userEmbed.set_image(url=image)
-                    try:
-                        await userObject.send(embed=userEmbed)
-                        success = f"Sent message to User {user['userid']}, Title: {user['title']} ({title}), SG: {scan_group}, MULink: {link}"
-                        await errorChannel.send(success)
-                    except discord.Forbidden:
-                        exception = f"Could not send message to User {user['userid']}, Title: {user['title']} ({title}), SG: {scan_group}, MULink: {link}"
-                        await errorChannel.send(exception)
-                        continue
-                except Exception:
-                    exception = f"Error on send message to User {user['userid']}, Title: {user['title']} ({title}), SG: {scan_group}, MULink: {link}\n{traceback.format_exc()}"
-                    await errorChannel.send(exception)
-                    continue
+                jobs.append((("user", user["userid"]), send_user(user)))
         else:
             print(f"New manga not wanted. (User: {title})")
         if serverWant:
             for server in serverWant:
-                try:
-                    channelObject = self.bot.get_channel(server["channelid"])
-                    channelEmbed = discord.Embed(title=f"New {server['title']} chapter released!", url=link, description=f"There is a new `{server['title']}` chapter.", color=0x3083e3)
-                    channelEmbed.set_author(name="MangaUpdates", icon_url=self.bot.user.avatar.url)
-                    channelEmbed.add_field(name="Chapter", value=chapter, inline=True)
-                    channelEmbed.add_field(name="Group", value=scan_group, inline=True)
-                    channelEmbed.add_field(name="Scanlator Link", value=scanLink, inline=False)
-                    if image != None:
-                        channelEmbed.set_image(url=image)
-                    try:
-                        await channelObject.send(embed=channelEmbed)
-                        success = f"Sent message to Server Channel {server['channelid']}, Title: {server['title']} ({title}), SG: {scan_group}, MULink: {link}"
-                        await errorChannel.send(success)
-                    except discord.Forbidden:
-                        exception = f"Could not send message to Server Channel {server['channelid']}, Title: {server['title']} ({title}), SG: {scan_group}, MULink: {link}"
-                        await errorChannel.send(exception)
-                        continue
-                except Exception:
-                    exception = f"Error on send message to Server Channel {server['channelid']}, Title: {server['title']} ({title}), SG: {scan_group}, MULink: {link}\n{traceback.format_exc()}"
-                    await errorChannel.send(exception)
-                    continue
+                jobs.append((("channel", server["channelid"]), send_channel(server)))
         else:
             print(f"New manga not wanted. (Server: {title})")
+        if not jobs:
+            return
+
+        if userWant:
+            await self.dms.preload([user["userid"] for user in userWant])
+        stats = await self.delivery.deliver(jobs)
+        await self.dms.save()
+        print(f"Delivered {title} ({chapter}), SG: {scan_group}, MULink: {link}: {stats.summary()}")
+        failures = [(f"{route[0]} {route[1]}", reason.strip().splitlines()[-1]) for route, reason in stats.failures]
+        self.bot.ops.event("delivered", title=title, chapter=chapter, group=scan_group, link=link, summary=stats.summary(),
+                           sent=stats.sent, forbidden=stats.forbidden, errors=stats.errors, failures=failures)
 
 def setup(bot):
     bot.add_cog(UpdateSending(bot))
\ No newline at end of file
@@ -0,0 +1,153 @@
+import asyncio
+import json
+import os
+import socket
+import time
+import traceback
+from datetime import datetime, timezone, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from core.rss import Release
+
+# big enough for a release payload with thousands of subscribers on one line
+LINE_LIMIT = 2 ** 24
+
+
+def shard_for(guild_id, shard_count):
+    # discord's own sharding formula
+    return (guild_id >> 22) % shard_count
+
+
+def user_cluster(user_id, cluster_count):
+    # users aren't tied to a shard, split them evenly so each cluster keeps its own dm channels warm
+    return user_id % cluster_count
+
+
+class Lease:
+    # a mongo document that at most one process holds at a time, renewed by calling acquire again before it expires
+    def __init__(self, mongo, name, ttl=60, owner=None):
+        self.mongo = mongo
+        self.name = name
+        self.ttl = ttl
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.held = False
+
+    async def acquire(self):
+        now = datetime.now(timezone.utc)
+        query = {"_id": self.name, "$or": [{"owner": self.owner}, {"expires": {"$lt": now}}]}
+        update = {"$set": {"owner": self.owner, "expires": now + timedelta(seconds=self.ttl)}}
+        try:
+            doc = await self.mongo.run("lease_acquire", self.mongo.leases.find_one_and_update, query, update, upsert=True, return_document=ReturnDocument.AFTER)
+            held = doc is not None and doc["owner"] == self.owner
+        except DuplicateKeyError:
+            # someone else holds an unexpired lease, the upsert collided with their document
+            held = False
+        if held != self.held:
+            print(f"{self.owner} {'acquired' if held else 'lost'} the {self.name} lease.")
+        self.held = held
+        return held
+
+    async def release(self):
+        if self.held:
+            await self.mongo.run("lease_release", self.mongo.leases.delete_one, {"_id": self.name, "owner": self.owner})
+            self.held = False
+
+
+class ClusterClient:
+    # connection from one shard cluster to the launcher's hub (cluster.py), newline delimited json both ways
+    def __init__(self, path, cluster_id, cluster_count):
+        self.path = path
+        self.cluster_id = cluster_id
+        self.cluster_count = cluster_count
+        self.reader = None
+        self.writer = None
+        self.handler = None
+        # releases that arrive before the delivery queue is up
+        self.backlog = []
+        # release key -> future resolved by the hub's routed confirmation
+        self.acks = {}
+        self.tasks = []
+        self.health_task = None
+        self.published = 0
+        self.received = 0
+        self.unrouted = 0
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
+        await self.send({"op": "hello", "cluster": self.cluster_id, "pid": os.getpid()})
+        self.tasks.append(asyncio.create_task(self.listen()))
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    async def send(self, message):
+        self.writer.write(json.dumps(message).encode() + b"\n")
+        await self.writer.drain()
+
+    async def publish(self, release, payload, timeout=10):
+        # the hub splits it up and sends each cluster (this one included) only the subscribers it delivers to.
+        # True once the hub confirms every part was sent or is waiting for its cluster, otherwise publish it again later
+        self.published += 1
+        future = asyncio.get_running_loop().create_future()
+        self.acks[release.key] = future
+        try:
+            await self.send({"op": "release", "key": release.key, "release": [release.title, release.chapter, release.scan_group, release.link], "payload": payload})
+            routed = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            print(f"Error: The launcher didn't confirm {release.title} {release.chapter} within {timeout}s.")
+            routed = False
+        finally:
+            self.acks.pop(release.key, None)
+        if not routed:
+            self.unrouted += 1
+        return routed
+
+    def set_handler(self, handler):
+        self.handler = handler
+        backlog, self.backlog = self.backlog, []
+        for release, payload in backlog:
+            asyncio.create_task(handler(release, payload))
+
+    async def listen(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                print(f"Error: Cluster {self.cluster_id} lost its connection to the launcher.")
+                for future in self.acks.values():
+                    if not future.done():
+                        future.set_result(False)
+                return
+            try:
+                message = json.loads(line)
+                if message["op"] == "routed":
+                    future = self.acks.get(message["key"])
+                    if future is not None and not future.done():
+                        future.set_result(message["ok"])
+                elif message["op"] == "release":
+                    self.received += 1
+                    release = Release(*message["release"])
+                    if self.handler is None:
+                        self.backlog.append((release, message["payload"]))
+                    else:
+                        await self.handler(release, message["payload"])
+            except Exception:
+                print(f"Error: Bad message from the launcher.\n{traceback.format_exc()}")
+
+    def start_health(self, collect, interval=30):
+        if self.health_task is not None:
+            return
+
+        async def report():
+            while True:
+                try:
+                    health = collect()
+                    health.update({"op": "health", "cluster": self.cluster_id, "published": self.published, "received": self.received, "time": time.time()})
+                    await self.send(health)
+                except Exception:
+                    print(f"Error: Could not send cluster health.\n{traceback.format_exc()}")
+                await asyncio.sleep(interval)
+        self.health_task = asyncio.create_task(report())
+        self.tasks.append(self.health_task)
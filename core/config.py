@@ -0,0 +1,193 @@
+import asyncio
+import time
+import traceback
+from datetime import datetime, timezone, timedelta
+
+class ConfigCache:
+    # in-memory copy of every server and user (channel, admin role, manga list), warmed at startup and kept
+    # coherent across processes with a change stream, or by polling updatedAt where change streams aren't available
+    PROJECTIONS = {
+        "server": {"serverid": 1, "channelid": 1, "roles.admin": 1, "manga.id": 1, "manga.title": 1, "manga.groupid": 1},
+        "user": {"userid": 1, "manga.id": 1, "manga.title": 1, "manga.groupid": 1},
+    }
+
+    def __init__(self, mongo, poll_interval=30, resync_interval=600):
+        self.mongo = mongo
+        self.poll_interval = poll_interval
+        # polling can't see deletes, a full reload every so often catches those
+        self.resync_interval = resync_interval
+        self.entries = {}
+        # change stream deletes only carry _id
+        self.keys = {}
+        self.by_id = {}
+        self.by_title = {}
+        self.ready = False
+        self.mode = None
+        self.task = None
+        self.stream = None
+        self.stopped = False
+        self.polled = None
+        self.synced = 0
+        self.events = 0
+        self.refreshes = 0
+
+    def collection(self, kind):
+        return self.mongo.srv if kind == "server" else self.mongo.usr
+
+    @staticmethod
+    def id_field(kind):
+        return "serverid" if kind == "server" else "userid"
+
+    def unindex(self, key):
+        doc = self.entries.pop(key, None)
+        if doc is None:
+            return
+        self.keys.pop(doc["_id"], None)
+        for manga in doc.get("manga", []):
+            self.by_id.get(manga.get("id"), set()).discard(key)
+            self.by_title.get(manga.get("title"), set()).discard(key)
+
+    def put(self, kind, doc):
+        key = (kind, doc[ConfigCache.id_field(kind)])
+        self.unindex(key)
+        doc = {field: doc[field] for field in ("_id", ConfigCache.id_field(kind), "channelid", "roles", "manga") if field in doc}
+        doc["manga"] = [{"id": m.get("id"), "title": m.get("title"), "groupid": m.get("groupid")} for m in doc.get("manga", [])]
+        self.entries[key] = doc
+        self.keys[doc["_id"]] = key
+        for manga in doc["manga"]:
+            self.by_id.setdefault(manga["id"], set()).add(key)
+            self.by_title.setdefault(manga["title"], set()).add(key)
+
+    def load_all_sync(self):
+        return {kind: list(self.collection(kind).find({}, ConfigCache.PROJECTIONS[kind])) for kind in ("server", "user")}
+
+    async def warm(self):
+        started = time.perf_counter()
+        polled = datetime.now(timezone.utc)
+        docs = await self.mongo.run("config_warm", self.load_all_sync)
+        self.entries, self.keys, self.by_id, self.by_title = {}, {}, {}, {}
+        for kind, items in docs.items():
+            for doc in items:
+                self.put(kind, doc)
+        self.polled = polled
+        self.synced = time.monotonic()
+        if not self.ready:
+            self.ready = True
+            print(f"Config cache loaded {len(docs['server'])} servers and {len(docs['user'])} users in {time.perf_counter() - started:.2f}s.")
+
+    async def start(self):
+        await self.warm()
+        self.task = asyncio.create_task(self.follow())
+
+    async def stop(self):
+        self.stopped = True
+        if self.stream is not None:
+            self.stream.close()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def refresh(self, kind, target_id):
+        # re-read one document after a local write so the next command or delivery sees it immediately
+        self.refreshes += 1
+        doc = await self.mongo.run("config_refresh", self.collection(kind).find_one, {ConfigCache.id_field(kind): target_id}, ConfigCache.PROJECTIONS[kind])
+        if doc is None:
+            self.unindex((kind, target_id))
+        else:
+            self.put(kind, doc)
+
+    def get(self, kind, target_id):
+        return self.entries.get((kind, target_id))
+
+    def wanted(self, lookups):
+        # same result as Mongo.manga_wanted_batch, answered from memory
+        wanted = {}
+        for lookup in lookups:
+            manga_id, manga_title = lookup
+            result = wanted[lookup] = {"servers": [], "users": []}
+            if manga_id is not None:
+                keys, match = self.by_id.get(manga_id, ()), lambda m: m["id"] == manga_id
+            elif manga_title is not None:
+                keys, match = self.by_title.get(manga_title, ()), lambda m: m["title"] == manga_title
+            else:
+                continue
+            for key in keys:
+                doc = self.entries[key]
+                for manga in doc["manga"]:
+                    if match(manga):
+                        if key[0] == "server":
+                            entry = {"serverid": key[1], "channelid": doc.get("channelid")}
+                        else:
+                            entry = {"userid": key[1]}
+                        entry["title"] = manga["title"]
+                        entry["groupid"] = manga["groupid"]
+                        result["servers" if key[0] == "server" else "users"].append(entry)
+        return wanted
+
+    def apply(self, change):
+        self.events += 1
+        kind = "server" if change["ns"]["coll"] == self.mongo.srv.name else "user"
+        operation = change["operationType"]
+        if operation in ("insert", "update", "replace") and change.get("fullDocument") is not None:
+            self.put(kind, change["fullDocument"])
+        elif operation in ("insert", "update", "replace", "delete"):
+            key = self.keys.get(change["documentKey"]["_id"])
+            if key is not None:
+                self.unindex(key)
+        else:
+            # drop, rename, invalidate: start over from the collections
+            asyncio.create_task(self.warm())
+
+    def watch_sync(self, loop):
+        names = [self.mongo.srv.name, self.mongo.usr.name]
+        # dm channel ids live on the user document but aren't config, their batched writes would each cost a lookup here
+        pipeline = [{"$match": {"ns.coll": {"$in": names}, "updateDescription.updatedFields.dmchannel": {"$exists": False}}}]
+        with self.mongo.srv.database.watch(pipeline, full_document="updateLookup") as stream:
+            self.stream = stream
+            loop.call_soon_threadsafe(setattr, self, "mode", "watch")
+            for change in stream:
+                loop.call_soon_threadsafe(self.apply, change)
+
+    def poll_sync(self, since):
+        return {kind: list(self.collection(kind).find({"updatedAt": {"$gte": since}}, ConfigCache.PROJECTIONS[kind])) for kind in ("server", "user")}
+
+    async def poll(self):
+        self.mode = "poll"
+        while not self.stopped:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                if time.monotonic() - self.synced > self.resync_interval:
+                    await self.warm()
+                    continue
+                # a little overlap so writes from processes with a slightly different clock aren't missed
+                since = self.polled - timedelta(seconds=5)
+                self.polled = datetime.now(timezone.utc)
+                for kind, docs in (await self.mongo.run("config_poll", self.poll_sync, since)).items():
+                    for doc in docs:
+                        self.events += 1
+                        self.put(kind, doc)
+            except Exception:
+                print(f"Error: Config cache poll failed.\n{traceback.format_exc()}")
+
+    async def follow(self):
+        loop = asyncio.get_running_loop()
+        while not self.stopped:
+            try:
+                # blocks on its own thread for as long as the stream is open
+                await loop.run_in_executor(None, self.watch_sync, loop)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                if self.stopped:
+                    return
+                if self.mode != "watch":
+                    # never got a stream (no replica set, mongomock, ...), poll from here on
+                    print(f"Change streams unavailable ({err!r}), polling for config changes every {self.poll_interval}s.")
+                    await self.poll()
+                    return
+                print(f"Error: Config change stream closed ({err!r}), reloading and reopening it.")
+                self.mode = None
+                await asyncio.sleep(5)
+                await self.warm()
+
+    def stats(self):
+        return {"mode": self.mode, "servers": sum(1 for key in self.entries if key[0] == "server"), "users": sum(1 for key in self.entries if key[0] == "user"), "events": self.events, "refreshes": self.refreshes}
@@ -0,0 +1,64 @@
+class AccountContext:
+    # everything a command checks about a user or server (exists, admin role, channel, manga list) used to be
+    # a separate find_one on the same document, this loads the document once per interaction and answers from it
+    PROJECTIONS = {
+        "server": {"channelid": 1, "roles.admin": 1, "manga.id": 1, "manga.title": 1},
+        "user": {"manga.id": 1, "manga.title": 1},
+    }
+
+    def __init__(self, mongo, kind, target_id, command=None):
+        self.mongo = mongo
+        self.kind = kind
+        self.target_id = target_id
+        self.command = command or f"{kind} context"
+        self.doc = None
+
+    async def load(self):
+        config = self.mongo.config
+        if config is not None and config.ready:
+            self.doc = config.get(self.kind, self.target_id)
+            if self.doc is not None:
+                return self
+        collection, field = (self.mongo.srv, "serverid") if self.kind == "server" else (self.mongo.usr, "userid")
+        self.doc = await self.mongo.run("context_load", collection.find_one, {field: self.target_id}, AccountContext.PROJECTIONS[self.kind])
+        self.stats()["queries"] += 1
+        return self
+
+    def stats(self):
+        return self.mongo.context_stats.setdefault(self.command, {"queries": 0, "served": 0})
+
+    def served(self):
+        # every answer below replaces what used to be its own query
+        self.stats()["served"] += 1
+
+    def exists(self):
+        self.served()
+        return self.doc is not None
+
+    def admin_role(self):
+        self.served()
+        if self.doc is None:
+            return None
+        return (self.doc.get("roles") or {}).get("admin")
+
+    def channel(self):
+        self.served()
+        if self.doc is None:
+            return None
+        return self.doc.get("channelid")
+
+    def manga_list(self):
+        # same shape as Mongo.get_manga_list_server/user, None for an empty list
+        self.served()
+        if self.doc is None or not self.doc.get("manga"):
+            return None
+        return [{"id": i["id"], "title": i["title"]} for i in self.doc["manga"]]
+
+    def has_manga(self, manga_id):
+        self.served()
+        if self.doc is None:
+            return False
+        return any(i["id"] == manga_id for i in self.doc.get("manga", []))
+
+    def is_admin(self, member):
+        return member.guild_permissions.administrator or (self.admin_role() in [r.id for r in member.roles])
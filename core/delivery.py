@@ -0,0 +1,153 @@
+import discord
+import asyncio
+import time
+import traceback
+from collections import OrderedDict
+from core.metrics import DELIVERIES, percentile
+
+class DeliveryStats:
+    def __init__(self):
+        self.sent = 0
+        self.forbidden = 0
+        self.errors = 0
+        self.failures = []
+        self.latencies = []
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+
+    @property
+    def total(self):
+        return self.sent + self.forbidden + self.errors
+
+    def throughput(self):
+        return self.total / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, p):
+        return percentile(self.latencies, p)
+
+    def summary(self):
+        return (f"{self.sent} sent, {self.forbidden} forbidden, {self.errors} errors in {self.elapsed:.2f}s "
+                f"({self.throughput():.1f} msg/s, p50 {self.percentile(50) * 1000:.0f}ms, p99 {self.percentile(99) * 1000:.0f}ms)")
+
+class DeliveryEngine:
+    # rate limits are the scheduler's (core/outbound.py), shared with everything else the bot sends
+    def __init__(self, scheduler, concurrency=10):
+        self.scheduler = scheduler
+        self.concurrency = concurrency
+
+    async def deliver(self, jobs):
+        # jobs are (route, send) pairs, route is a hashable bucket key and send a coroutine function
+        stats = DeliveryStats()
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+
+        async def worker():
+            while True:
+                try:
+                    route, send = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await self.scheduler.acquire("delivery", route)
+                start = time.perf_counter()
+                try:
+                    await send()
+                    stats.sent += 1
+                    DELIVERIES.inc(kind=route[0], outcome="sent")
+                except discord.Forbidden:
+                    stats.forbidden += 1
+                    stats.failures.append((route, "forbidden"))
+                    DELIVERIES.inc(kind=route[0], outcome="forbidden")
+                except Exception:
+                    stats.errors += 1
+                    stats.failures.append((route, traceback.format_exc(limit=2)))
+                    DELIVERIES.inc(kind=route[0], outcome="error")
+                stats.latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*[worker() for _ in range(min(self.concurrency, len(jobs)))])
+        stats.finish()
+        return stats
+
+class DMChannels:
+    # user id -> dm channel id, kept in memory and on the user document, so a repeat dm is one request
+    # to the channel instead of opening the dm first. stored ids are loaded for a whole tick at once
+    # and new ones are written back in one batch after each delivery
+    def __init__(self, bot, mongo, scheduler, maxsize=50000):
+        self.bot = bot
+        self.mongo = mongo
+        self.scheduler = scheduler
+        self.maxsize = maxsize
+        # None is a user that has no stored channel yet
+        self.channels = OrderedDict()
+        # user id -> channel id (or None for a dead one) not written to mongo yet
+        self.unsaved = {}
+        # user id -> task opening the dm, shared by releases that reach a new user at the same time
+        self.opening = {}
+        self.hits = 0
+        self.stored = 0
+        self.opened = 0
+
+    def remember(self, user_id, channel_id):
+        self.channels[user_id] = channel_id
+        self.channels.move_to_end(user_id)
+        if len(self.channels) > self.maxsize:
+            self.channels.popitem(last=False)
+
+    async def preload(self, user_ids):
+        # one query for every user this process hasn't looked up yet
+        missing = [user_id for user_id in set(user_ids) if user_id not in self.channels]
+        if not missing:
+            return
+        found = await self.mongo.get_dm_channels(missing)
+        self.stored += len(found)
+        for user_id in missing:
+            self.remember(user_id, found.get(user_id))
+
+    async def save(self):
+        if not self.unsaved:
+            return
+        unsaved, self.unsaved = self.unsaved, {}
+        try:
+            await self.mongo.save_dm_channels(unsaved)
+        except Exception as err:
+            # still cached in memory, only another process or a restart pays for the lookup again
+            print(f"Error: Could not save {len(unsaved)} dm channels: {err!r}")
+
+    async def channel_id(self, user_id):
+        if user_id not in self.channels:
+            await self.preload([user_id])
+        channel_id = self.channels.get(user_id)
+        if channel_id is not None:
+            self.hits += 1
+            self.channels.move_to_end(user_id)
+            return channel_id
+        task = self.opening.get(user_id)
+        if task is None:
+            task = self.opening[user_id] = asyncio.create_task(self.open_dm(user_id))
+            task.add_done_callback(lambda _: self.opening.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def open_dm(self, user_id):
+        self.opened += 1
+        # the id is enough to open a dm, the user isn't fetched first. it comes out of the same budget as the messages
+        await self.scheduler.acquire("delivery", ("create_dm", user_id))
+        channel_id = (await self.bot.create_dm(discord.Object(id=user_id))).id
+        self.remember(user_id, channel_id)
+        self.unsaved[user_id] = channel_id
+        return channel_id
+
+    async def send(self, user_id, **kwargs):
+        channel_id = await self.channel_id(user_id)
+        try:
+            await self.bot.get_partial_messageable(channel_id, type=discord.ChannelType.private).send(**kwargs)
+        except discord.NotFound:
+            # the channel is gone (deleted account, ...), look it up again next time
+            self.remember(user_id, None)
+            self.unsaved[user_id] = None
+            raise
+
+    def stats(self):
+        return {"cached": len(self.channels), "hits": self.hits, "stored": self.stored, "opened": self.opened}
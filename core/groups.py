@@ -0,0 +1,80 @@
+import asyncio
+import time
+from core.utils import Util
+
+util = Util()
+
+class GroupResolver:
+    def __init__(self, mangaupdates, store=None):
+        self.mangaupdates = mangaupdates
+        # mongo-backed copy of the index (see Mongo.load_groups/save_group) so restarts start warm
+        self.store = store
+        self.index = {}
+        # names the api had no match for, not retried until the entry expires
+        self.unknown = {}
+        self.hits = 0
+        self.lookups = 0
+        self.failed = 0
+
+    @staticmethod
+    def normalize(name):
+        return " ".join(util.format_group_name(name).split()).casefold()
+
+    @staticmethod
+    def split(scan_group):
+        # "&#039;" has to be decoded before splitting on "&" or apostrophes would split names
+        return [name.strip() for name in util.format_group_name(scan_group).split("&") if name.strip()]
+
+    async def load(self):
+        if self.store is None:
+            return
+        for doc in await self.store.load_groups():
+            self.index[doc["_id"]] = doc["record"]
+
+    async def remember(self, record, name=None):
+        names = set([GroupResolver.normalize(record["name"])])
+        if name is not None:
+            names.add(GroupResolver.normalize(name))
+        for key in names:
+            if self.index.get(key) != record:
+                self.index[key] = record
+                if self.store is not None:
+                    await self.store.save_group(key, record)
+
+    async def lookup(self, name):
+        self.lookups += 1
+        search = await self.mangaupdates.search_groups(name)
+        results = [result["record"] for result in search.get("results", [])]
+        if not results:
+            self.failed += 1
+            self.unknown[GroupResolver.normalize(name)] = time.monotonic() + 60 * 60
+            return None
+        key = GroupResolver.normalize(name)
+        # prefer an exact name match, otherwise keep the old behaviour of taking the first result
+        record = next((r for r in results if GroupResolver.normalize(r["name"]) == key), results[0])
+        await self.remember(record, name)
+        return record
+
+    async def resolve(self, scan_group):
+        if not scan_group:
+            return []
+        whole = self.index.get(GroupResolver.normalize(scan_group))
+        if whole is not None:
+            self.hits += 1
+            return [whole]
+        names = GroupResolver.split(scan_group)
+        now = time.monotonic()
+        missing = list(dict.fromkeys(name for name in names if GroupResolver.normalize(name) not in self.index and self.unknown.get(GroupResolver.normalize(name), 0) < now))
+        self.hits += len(names) - len(missing)
+        if missing:
+            # every collaborator that isn't indexed yet is looked up once, all at the same time
+            await asyncio.gather(*[self.lookup(name) for name in missing])
+        records = []
+        for name in names:
+            record = self.index.get(GroupResolver.normalize(name))
+            if record is not None and record not in records:
+                records.append(record)
+        return records
+
+    def stats(self):
+        return {"size": len(self.index), "hits": self.hits, "lookups": self.lookups, "failed": self.failed}
@@ -0,0 +1,119 @@
+import asyncio
+import time
+import traceback
+from collections import deque
+from core.metrics import percentile
+from core.rss import Release
+
+class ReleaseJob:
+    __slots__ = ("release", "payload", "enqueued", "attempts")
+
+    def __init__(self, release, payload=None, enqueued=None, attempts=0):
+        self.release = release
+        # in-memory extras resolved by the poller (e.g. subscribers), not persisted
+        self.payload = payload
+        self.enqueued = enqueued if enqueued is not None else time.time()
+        self.attempts = attempts
+
+class ReleaseQueue:
+    def __init__(self, handler, consumers=2, max_attempts=3, retry_delay=30, on_dead_letter=None, store=None):
+        self.handler = handler
+        self.consumers = consumers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.on_dead_letter = on_dead_letter
+        # optional mongo-backed copy of pending jobs so they survive a restart
+        self.store = store
+        self.queue = asyncio.Queue()
+        self.pending = set()
+        self.tasks = []
+        self.waiting = set()
+        self.in_flight = 0
+        self.enqueued = 0
+        self.delivered = 0
+        self.retried = 0
+        self.dead_letters = deque(maxlen=100)
+        self.latencies = deque(maxlen=1000)
+
+    async def start(self):
+        if self.tasks:
+            return
+        if self.store is not None:
+            for doc in await self.store.load_jobs():
+                release = Release(doc["title"], doc["chapter"], doc["scan_group"], doc["link"])
+                if release.key not in self.pending:
+                    self.pending.add(release.key)
+                    self.queue.put_nowait(ReleaseJob(release, None, doc["enqueued"], doc.get("attempts", 0)))
+        self.tasks = [asyncio.create_task(self.consume()) for _ in range(self.consumers)]
+
+    async def stop(self):
+        for task in self.tasks + list(self.waiting):
+            task.cancel()
+        self.tasks = []
+
+    async def put(self, release, payload=None):
+        if release.key in self.pending:
+            return False
+        job = ReleaseJob(release, payload)
+        self.pending.add(release.key)
+        if self.store is not None:
+            await self.store.save_job(release, job.enqueued)
+        self.enqueued += 1
+        self.queue.put_nowait(job)
+        return True
+
+    async def retry_later(self, job, delay):
+        await asyncio.sleep(delay)
+        self.queue.put_nowait(job)
+
+    async def finish(self, job):
+        self.pending.discard(job.release.key)
+        if self.store is not None:
+            await self.store.delete_job(job.release.key)
+
+    async def consume(self):
+        while True:
+            job = await self.queue.get()
+            self.in_flight += 1
+            try:
+                await self.handler(job.release, job.payload)
+                self.delivered += 1
+                self.latencies.append(time.time() - job.enqueued)
+                await self.finish(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                job.attempts += 1
+                error = traceback.format_exc()
+                print(f"Error: delivery of {job.release.title} failed (attempt {job.attempts}/{self.max_attempts})\n{error}")
+                if job.attempts < self.max_attempts:
+                    self.retried += 1
+                    if self.store is not None:
+                        await self.store.save_job(job.release, job.enqueued, job.attempts)
+                    task = asyncio.create_task(self.retry_later(job, self.retry_delay * 2 ** (job.attempts - 1)))
+                    self.waiting.add(task)
+                    task.add_done_callback(self.waiting.discard)
+                else:
+                    self.dead_letters.append((job.release, error))
+                    await self.finish(job)
+                    if self.on_dead_letter is not None:
+                        await self.on_dead_letter(job.release, error)
+            finally:
+                self.in_flight -= 1
+                self.queue.task_done()
+
+    def latency(self, p):
+        return percentile(self.latencies, p)
+
+    def stats(self):
+        return {
+            "depth": self.queue.qsize(),
+            "waiting_retry": len(self.waiting),
+            "in_flight": self.in_flight,
+            "enqueued": self.enqueued,
+            "delivered": self.delivered,
+            "retried": self.retried,
+            "dead_letters": len(self.dead_letters),
+            "latency_p50": self.latency(50),
+            "latency_p95": self.latency(95),
+        }
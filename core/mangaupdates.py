@@ -1,42 +1,170 @@
 import os
+import re
+import time
+import asyncio
 import numpy
-import aiohttp
-from bs4 import BeautifulSoup
+from core.metrics import API_SECONDS
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+SERIES_LINK_RE = re.compile(r"mangaupdates\.com/series/([0-9a-z]+)")
+GROUP_LINK_RE = re.compile(r"mangaupdates\.com/group/([0-9a-z]+)")
+CANONICAL_RE = re.compile(rb'<link[^>]+rel="canonical"[^>]+href="([^"]+)"|<link[^>]+href="([^"]+)"[^>]+rel="canonical"')
+# numeric/base36 path segments, collapsed so api metrics are per endpoint rather than per series
+PATH_ID_RE = re.compile(r"/(?!v\d+(?=/|$))[0-9a-z]*[0-9][0-9a-z]*(?=/|$)")
+# old series.html?id= ids were sequential and stayed in the hundreds of thousands, new ids are 7 base36 digits
+# (at least 36 ** 6, about 2.2e9, in decimal), so anything from 10 ** 7 up is a new id written out in decimal
+LEGACY_ID_MAX = 10 ** 7
 
 class RequestsMU:
-    def __init__(self):
+    def __init__(self, session):
         self.username = os.environ.get("MU_USER")
         self.password = os.environ.get("MU_PASS")
         self.loginurl = "https://api.mangaupdates.com/v1/account/login"
-        self.session = aiohttp.ClientSession()
+        self.session = session
+        self.token = None
+        self.headers = None
+        self.token_expires = 0
+        # sessions are long-lived on MU's side, refresh well before that anyway
+        self.token_lifetime = int(os.environ.get("MU_TOKEN_LIFETIME", 3600))
+        self.login_lock = asyncio.Lock()
+        self.logins = 0
+        self.requests = 0
+
     async def login(self):
         async with self.session.put(self.loginurl, json={"username": self.username, "password": self.password}) as resp:
             login = await resp.json()
             self.token = login["context"]["session_token"]
             self.headers = {"Authorization": f"Bearer {self.token}"}
+            self.token_expires = time.monotonic() + self.token_lifetime
+            self.logins += 1
+            return self.headers
+
+    def token_valid(self):
+        return self.token is not None and time.monotonic() < self.token_expires
+
+    async def get_headers(self, stale_token=None):
+        # only one coroutine logs in, the rest wait on the lock and reuse its token
+        if self.token_valid() and self.token != stale_token:
             return self.headers
+        async with self.login_lock:
+            if self.token_valid() and self.token != stale_token:
+                return self.headers
+            return await self.login()
+
+    async def request(self, method, url, raw=False, **kwargs):
+        self.requests += 1
+        headers = await self.get_headers()
+        token = self.token
+        endpoint = PATH_ID_RE.sub("/{id}", urlparse(url).path)
+        for attempt in range(2):
+            started = time.perf_counter()
+            status = "error"
+            try:
+                async with self.session.request(method, url, headers=headers, **kwargs) as resp:
+                    status = resp.status
+                    if resp.status == 401 and attempt == 0:
+                        headers = await self.get_headers(stale_token=token)
+                        token = self.token
+                        continue
+                    if raw:
+                        return await resp.text()
+                    return await resp.json()
+            finally:
+                API_SECONDS.observe(time.perf_counter() - started, method=method, endpoint=endpoint, status=status)
+
+    def stats(self):
+        return {"logins": self.logins, "requests": self.requests, "saved": self.requests - self.logins}
+
     async def get(self, url):
-        await self.login()
-        async with self.session.get(url, headers=self.headers) as resp:
-            return await resp.json()
+        return await self.request("GET", url)
+
     async def getRaw(self, url):
-        await self.login()
-        async with self.session.get(url, headers=self.headers) as resp:
-            return await resp.text()
+        return await self.request("GET", url, raw=True)
+
     async def put(self, url, data):
-        await self.login()
-        async with self.session.put(url, headers=self.headers, json=data) as resp:
-            return await resp.json()
+        return await self.request("PUT", url, json=data)
+
     async def post(self, url, data):
-        await self.login()
-        async with self.session.post(url, headers=self.headers, json=data) as resp:
-            return await resp.json()
-    async def close(self):
-        await self.session.close()
+        return await self.request("POST", url, json=data)
+
+class AsyncTTLCache:
+    def __init__(self, name, ttl, maxsize, store=None):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # optional second tier (see Mongo.cache_get/cache_set) that keeps entries warm across restarts
+        self.store = store
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.store_hits = 0
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def load(self, key, fetch, valid):
+        if self.store is not None:
+            value = await self.store.cache_get(self.name, key)
+            if value is not None:
+                self.store_hits += 1
+                self.set(key, value)
+                return value
+        value = await fetch()
+        # error payloads from the api are passed through but never cached
+        if valid(value):
+            self.set(key, value)
+            if self.store is not None:
+                await self.store.cache_set(self.name, key, value, self.ttl)
+        return value
+
+    async def get(self, key, fetch, valid=lambda value: True):
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.entries[key]
+        task = self.inflight.get(key)
+        if task is not None:
+            # concurrent misses share the fetch that is already running
+            self.coalesced += 1
+            return await asyncio.shield(task)
+        self.misses += 1
+        task = asyncio.ensure_future(self.load(key, fetch, valid))
+        self.inflight[key] = task
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if self.inflight.get(key) is task:
+                del self.inflight[key]
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "evictions": self.evictions, "store_hits": self.store_hits}
 
 class MangaUpdates:
-    def __init__(self):
-        self.rq = RequestsMU()
+    def __init__(self, session, cache_store=None):
+        self.rq = RequestsMU(session)
+        # called with every group record fetched through group_info, feeds the local group index
+        self.on_group = None
+        self.caches = {
+            "series_info": AsyncTTLCache("series_info", ttl=60 * 60 * 6, maxsize=2000, store=cache_store),
+            "series_groups": AsyncTTLCache("series_groups", ttl=60 * 60, maxsize=1000, store=cache_store),
+            "group_info": AsyncTTLCache("group_info", ttl=60 * 60 * 24, maxsize=2000, store=cache_store),
+            # old id -> new id never changes, keep it around for a long time
+            "legacy_ids": AsyncTTLCache("legacy_ids", ttl=60 * 60 * 24 * 30, maxsize=5000, store=cache_store),
+        }
+
+    def cache_stats(self):
+        return {name: cache.stats() for name, cache in self.caches.items()}
 
     async def convert_old_id(self, old_id):
         enc = numpy.base_repr(old_id, 36).lower()
@@ -45,13 +173,45 @@ class MangaUpdates:
     async def convert_new_id(self, new_id):
         return int(new_id, 36)
 
-    async def getCanonical(self, link):
-        canonical = await self.rq.getRaw(link)
-        soup = BeautifulSoup(canonical, "html.parser")
-        link = soup.find("link", {"rel": "canonical"})
-        canonical = link["href"]
-        return canonical
-    
+    @staticmethod
+    async def read_canonical(session, url, pattern):
+        # returns the base 36 id from the page's canonical url without downloading or parsing the whole page
+        async with session.get(url) as resp:
+            # old pages usually redirect to the new url, then the body isn't needed at all
+            match = pattern.search(str(resp.url))
+            if match:
+                return match.group(1)
+            resp.raise_for_status()
+            head = b""
+            async for chunk in resp.content.iter_chunked(4096):
+                head += chunk
+                link = CANONICAL_RE.search(head)
+                if link:
+                    match = pattern.search((link.group(1) or link.group(2)).decode())
+                    return match.group(1) if match else None
+                if b"</head>" in head:
+                    return None
+        return None
+
+    async def fetch_legacy_id(self, old_id):
+        new = await MangaUpdates.read_canonical(self.rq.session, f"https://www.mangaupdates.com/series.html?id={old_id}", SERIES_LINK_RE)
+        return {"series_id": await self.convert_new_id(new)} if new else {}
+
+    async def series_id_from_link(self, link):
+        match = SERIES_LINK_RE.search(link)
+        if match:
+            return await self.convert_new_id(match.group(1))
+        url = urlparse(link)
+        old_id = parse_qs(url.query).get("id", [""])[0]
+        if not url.netloc.endswith("mangaupdates.com") or not url.path.endswith("series.html") or not old_id.isdigit():
+            return None
+        old_id = int(old_id)
+        if old_id >= LEGACY_ID_MAX:
+            return old_id
+        # only real legacy ids need the website, once each
+        result = await self.caches["legacy_ids"].get(old_id, lambda: self.fetch_legacy_id(old_id), lambda result: "series_id" in result)
+        return result.get("series_id")
+
     async def search_series(self, series_name):
         searchurl = f"https://api.mangaupdates.com/v1/series/search"
         search = await self.rq.post(searchurl, data={"search": series_name, "perpage": 10})
@@ -59,7 +219,7 @@ class MangaUpdates:
     
     async def series_info(self, series_id):
         infourl = f"https://api.mangaupdates.com/v1/series/{series_id}"
-        info = await self.rq.get(infourl)
+        info = await self.caches["series_info"].get(series_id, lambda: self.rq.get(infourl), lambda info: "series_id" in info)
         return info
 
     async def search_groups(self, group_name):
@@ -69,12 +229,12 @@ class MangaUpdates:
 
     async def group_info(self, group_id):
         infourl = f"https://api.mangaupdates.com/v1/groups/{group_id}"
-        info = await self.rq.get(infourl)
+        info = await self.caches["group_info"].get(group_id, lambda: self.rq.get(infourl), lambda info: "group_id" in info)
+        if self.on_group is not None and "group_id" in info:
+            await self.on_group(info)
         return info
 
     async def series_groups(self, series_id):
         groupsurl = f"https://api.mangaupdates.com/v1/series/{series_id}/groups"
-        groups = await self.rq.get(groupsurl)
+        groups = await self.caches["series_groups"].get(series_id, lambda: self.rq.get(groupsurl), lambda groups: "group_list" in groups)
         return groups
-    async def close(self):
-        await self.rq.close()
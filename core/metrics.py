@@ -0,0 +1,193 @@
+import time
+from aiohttp import web
+
+# latency buckets in seconds, from a cached mongo lookup up to a slow feed fetch
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (list(extra.items()) if extra else [])
+    if not pairs:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        return self.header() + [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}" for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        # called at scrape time, returns a number or {label values tuple: number}
+        self.function = function
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def render(self):
+        values = self.values
+        if self.function is not None:
+            try:
+                result = self.function()
+            except Exception as err:
+                print(f"Error: Could not collect {self.name}: {err!r}")
+                result = {}
+            values = result if isinstance(result, dict) else {(): result}
+        return self.header() + [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}" for key, value in values.items() if value is not None]
+
+
+def percentile(values, p):
+    # nearest rank over raw samples, for reports that keep them rather than buckets
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series["counts"][i] += 1
+                break
+        series["sum"] += value
+        series["count"] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def render(self):
+        lines = self.header()
+        for key, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series["counts"]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, {'le': format_value(bound)})} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_value(series['sum'])}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {series['count']}")
+        return lines
+
+
+class Timer:
+    # with HISTOGRAM.time(label=...): ...  labels can still be filled in inside the block
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        if metric.name in self.metrics:
+            return self.metrics[metric.name]
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), function=None):
+        gauge = self.add(Gauge(name, help, labels))
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+FEED_FETCH_SECONDS = REGISTRY.histogram("mu_feed_fetch_seconds", "RSS feed fetch latency", ("status",))
+FEED_BYTES = REGISTRY.histogram("mu_feed_bytes", "RSS feed body size", buckets=(1024, 4096, 16384, 65536, 262144, 1048576))
+FEED_ENTRIES = REGISTRY.gauge("mu_feed_entries", "Releases in the last parsed feed")
+TICK_SECONDS = REGISTRY.histogram("mu_tick_stage_seconds", "Time spent in each stage of check_for_updates", ("stage",))
+TICK_RELEASES = REGISTRY.histogram("mu_tick_new_releases", "New releases found per update tick", buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+MONGO_SECONDS = REGISTRY.histogram("mu_mongo_seconds", "MongoDB call latency by operation", ("op",))
+MONGO_ERRORS = REGISTRY.counter("mu_mongo_errors_total", "MongoDB calls that raised, by operation", ("op",))
+API_SECONDS = REGISTRY.histogram("mu_api_seconds", "MangaUpdates API latency by endpoint and status", ("method", "endpoint", "status"))
+DELIVERIES = REGISTRY.counter("mu_deliveries_total", "Chapter notifications by recipient kind and outcome", ("kind", "outcome"))
+# observed by core.watchdog.LoopWatchdog
+LOOP_LAG = REGISTRY.histogram("mu_loop_lag_seconds", "Event loop scheduling delay", buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+
+
+class MetricsServer:
+    # text exposition format on /metrics, meant for a local prometheus scraper
+    def __init__(self, host="127.0.0.1", port=9100, registry=REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.runner = None
+
+    async def handle(self, request):
+        return web.Response(body=self.registry.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        print(f"Metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
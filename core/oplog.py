@@ -0,0 +1,78 @@
+import json
+import logging
+import logging.handlers
+import queue
+import time
+from datetime import datetime, timezone
+
+
+class OpLog:
+    # operational events (new releases, who wanted them, delivery results, errors) are buffered here and go to the
+    # log channel as one digest per update tick instead of a message each. every event is also written as a json
+    # line to a rotating file, from a background thread so nothing on the delivery path waits on disk
+    def __init__(self, outbound, path="ops.jsonl", max_bytes=10 * 1024 * 1024, backups=5):
+        self.outbound = outbound
+        self.events = []
+        self.flushed = 0
+        self.logger = logging.getLogger(f"mangaupdates.ops.{id(self)}")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.listener = None
+        if path:
+            records = queue.SimpleQueue()
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(logging.handlers.QueueHandler(records))
+            self.listener = logging.handlers.QueueListener(records, handler)
+            self.listener.start()
+
+    def event(self, kind, **fields):
+        fields = {"time": datetime.now(timezone.utc).isoformat(), "event": kind, **fields}
+        self.events.append(fields)
+        self.logger.info(json.dumps(fields, default=str))
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    @staticmethod
+    def describe(event):
+        kind = event["event"]
+        if kind == "tick":
+            return f"{event['new']} new releases, queue depth {event['depth']}, {event['dead_letters']} dead letters"
+        if kind == "wanted":
+            return f"{event['title']}: wanted by {event['servers']} servers and {event['users']} users"
+        if kind == "delivered":
+            line = f"Delivered {event['title']} ({event['chapter']}), SG: {event['group']}, MULink: {event['link']}: {event['summary']}"
+            return "\n".join([line] + [f"  {route}: {reason}" for route, reason in event["failures"]])
+        if kind == "dead_letter":
+            return f"Error: Gave up notifying for {event['title']} ({event['link']}).\n{event['error']}"
+        if kind == "error":
+            return f"Error: {event['message']}"
+        return json.dumps(event, default=str)
+
+    def digest(self, events):
+        started = time.strftime("%H:%M:%S")
+        unwanted = [e["title"] for e in events if e["event"] == "wanted" and not e["servers"] and not e["users"]]
+        lines = [f"Update digest {started} ({len(events)} events)"]
+        lines += [OpLog.describe(e) for e in events if not (e["event"] == "wanted" and not e["servers"] and not e["users"])]
+        if unwanted:
+            lines.append(f"Not wanted by anyone: {', '.join(unwanted)}")
+        return "\n".join(lines)
+
+    def flush(self):
+        # called once per tick, hands the digest to the scheduler's diagnostics lane and returns right away
+        events, self.events = self.events, []
+        if not events:
+            return
+        self.flushed += 1
+        digest = self.digest(events)
+        if len(digest) <= 2000:
+            self.outbound.log(digest)
+        else:
+            summary = digest.split("\n", 1)[0]
+            self.outbound.log_file(summary, f"digest-{int(time.time())}.txt", digest.encode())
+
+    def stats(self):
+        return {"buffered": len(self.events), "digests": self.flushed}
@@ -0,0 +1,176 @@
+import asyncio
+import discord
+import heapq
+import io
+import itertools
+import time
+from collections import OrderedDict
+
+# highest priority first: a user waiting on a command, then chapter notifications, then our own log lines
+LANES = ("interaction", "delivery", "diagnostics")
+
+
+class TokenBucket:
+    def __init__(self, rate, per):
+        self.capacity = rate
+        self.per = per
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / self.per)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) * self.per / self.capacity)
+
+
+class OutboundScheduler:
+    # every message the bot sends by itself goes through here (interaction responses have their own limits).
+    # the per-channel and global buckets are spent before the request is made rather than after a 429, the global
+    # budget goes to the highest priority lane that is waiting, and log lines are merged into as few messages as
+    # fit and dropped oldest first when deliveries need the budget
+    def __init__(self, bot, global_rate=45, route_rate=5, route_per=5.0, max_routes=10000, log_channel_id=None, log_interval=5, max_log_lines=500):
+        self.bot = bot
+        # discord allows 50 requests/s globally and 5 messages per 5s per channel, stay a little under both
+        self.global_bucket = TokenBucket(global_rate, 1.0)
+        self.route_rate = route_rate
+        self.route_per = route_per
+        self.max_routes = max_routes
+        self.routes = OrderedDict()
+        self.waiting = []
+        self.order = itertools.count()
+        self.queued = {lane: 0 for lane in LANES}
+        self.sent = {lane: 0 for lane in LANES}
+        self.wait_time = {lane: 0.0 for lane in LANES}
+        self.wake = asyncio.Event()
+        self.dispatcher = None
+        self.log_channel_id = log_channel_id
+        self.log_interval = log_interval
+        self.max_log_lines = max_log_lines
+        # line -> times it was logged since the last flush
+        self.log_lines = OrderedDict()
+        # (content, filename, data) for logs too long for one message
+        self.log_files = []
+        self.log_task = None
+        self.coalesced = 0
+        self.dropped = 0
+
+    def route_bucket(self, route):
+        bucket = self.routes.get(route)
+        if bucket is None:
+            bucket = self.routes[route] = TokenBucket(self.route_rate, self.route_per)
+            if len(self.routes) > self.max_routes:
+                self.routes.popitem(last=False)
+        else:
+            self.routes.move_to_end(route)
+        return bucket
+
+    def pressure(self):
+        return self.queued["interaction"] + self.queued["delivery"]
+
+    async def dispatch(self):
+        # hands out one global token at a time to the highest priority waiter
+        while True:
+            while not self.waiting:
+                self.wake.clear()
+                await self.wake.wait()
+            await self.global_bucket.acquire()
+            while self.waiting:
+                _, _, future = heapq.heappop(self.waiting)
+                if not future.done():
+                    future.set_result(None)
+                    break
+
+    async def acquire(self, lane, route):
+        await self.route_bucket(route).acquire()
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self.dispatch())
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (LANES.index(lane), next(self.order), future))
+        self.queued[lane] += 1
+        self.wake.set()
+        start = time.perf_counter()
+        try:
+            await future
+        finally:
+            self.queued[lane] -= 1
+        self.wait_time[lane] += time.perf_counter() - start
+        self.sent[lane] += 1
+
+    async def send(self, lane, channel, **kwargs):
+        await self.acquire(lane, ("channel", channel.id))
+        return await channel.send(**kwargs)
+
+    def log(self, message):
+        # never waits, the line goes out with the next flush
+        if message in self.log_lines:
+            self.log_lines[message] += 1
+            self.log_lines.move_to_end(message)
+            self.coalesced += 1
+        else:
+            self.log_lines[message] = 1
+            if len(self.log_lines) > self.max_log_lines:
+                self.log_lines.popitem(last=False)
+                self.dropped += 1
+        self.schedule_logs()
+
+    def log_file(self, content, filename, data):
+        self.log_files.append((content, filename, data))
+        self.schedule_logs()
+
+    def schedule_logs(self):
+        if self.log_task is None or self.log_task.done():
+            self.log_task = asyncio.create_task(self.flush_logs())
+
+    def log_messages(self):
+        lines, self.log_lines = self.log_lines, OrderedDict()
+        dropped, self.dropped = self.dropped, 0
+        messages = []
+        current = f"({dropped} log lines dropped)" if dropped else ""
+        for line, count in lines.items():
+            line = f"{line} (x{count})" if count > 1 else line
+            for part in [line[i:i + 2000] for i in range(0, len(line), 2000)] or [""]:
+                if current and len(current) + 1 + len(part) > 2000:
+                    messages.append(current)
+                    current = ""
+                current = f"{current}\n{part}" if current else part
+        if current:
+            messages.append(current)
+        return messages
+
+    async def flush_logs(self):
+        # lines logged while a flush is sending go out with the next round
+        while self.log_lines or self.dropped or self.log_files:
+            await asyncio.sleep(self.log_interval)
+            # deliveries are waiting on the budget, keep collecting until they are through
+            while self.pressure():
+                await asyncio.sleep(self.log_interval)
+            channel = self.bot.get_channel(self.log_channel_id) if self.log_channel_id else None
+            for message in self.log_messages():
+                if channel is None:
+                    # no log channel configured, or it lives on another cluster
+                    print(message)
+                    continue
+                try:
+                    await self.send("diagnostics", channel, content=message)
+                except Exception as err:
+                    print(f"Error: Could not send to the log channel: {err!r}\n{message}")
+            files, self.log_files = self.log_files, []
+            for content, filename, data in files:
+                if channel is None:
+                    print(data.decode())
+                    continue
+                try:
+                    await self.send("diagnostics", channel, content=content, file=discord.File(io.BytesIO(data), filename=filename))
+                except Exception as err:
+                    print(f"Error: Could not send {filename} to the log channel: {err!r}")
+
+    def stats(self):
+        return {"queued": dict(self.queued), "sent": dict(self.sent), "wait": {lane: round(self.wait_time[lane], 3) for lane in LANES},
+                "log_lines": len(self.log_lines), "coalesced": self.coalesced, "dropped": self.dropped}
@@ -1,44 +1,122 @@
 import feedparser
+import asyncio
+import hashlib
 import re
+import time
+from core.mangaupdates import SERIES_LINK_RE
+from core.metrics import FEED_FETCH_SECONDS, FEED_BYTES, FEED_ENTRIES
+
+NOT_MODIFIED = object()
+CHAPTER_RE = re.compile(r"(v.\d{1,} )?c.\d{1,}(\.\d)?(-\d{1,}(\.\d)?)?")
+GROUP_RE = re.compile(r"(?<=\[).+?(?=\])")
+HTTP_RE = re.compile("^http://")
+
+class Release:
+    __slots__ = ("title", "chapter", "scan_group", "link", "key")
+
+    def __init__(self, title, chapter, scan_group, link):
+        self.title = title
+        self.chapter = chapter
+        self.scan_group = scan_group
+        self.link = link
+        # stable across restarts (unlike hash()), this is also the seen-release ledger id
+        fields = "\x1f".join(x or "" for x in (title, chapter, scan_group, link))
+        self.key = hashlib.sha1(fields.encode("utf-8")).hexdigest()
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, Release) and self.key == other.key
+
+    def series_id(self):
+        # base 36 id from the series link, same conversion as MangaUpdates.convert_new_id
+        if not self.link:
+            return None
+        match = SERIES_LINK_RE.search(self.link)
+        if match is None:
+            return None
+        return int(match.group(1), 36)
+
+    def __repr__(self):
+        return f"Release({self.title!r}, {self.chapter!r}, {self.scan_group!r}, {self.link!r})"
 
 class RSSParser:
+    def __init__(self, session):
+        self.session = session
+        self.url = "https://api.mangaupdates.com/v1/releases/rss"
+        self.etag = None
+        self.modified = None
+        self.last = None
+        self.fetches = 0
+        self.not_modified = 0
+
+    async def __fetch(self):
+        headers = {}
+        # only ask for a 304 when there is a parsed feed to fall back on
+        if self.last is not None:
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.modified:
+                headers["If-Modified-Since"] = self.modified
+        started = time.perf_counter()
+        status = "error"
+        try:
+            async with self.session.get(self.url, headers=headers) as resp:
+                self.fetches += 1
+                status = resp.status
+                if resp.status == 304:
+                    self.not_modified += 1
+                    return NOT_MODIFIED
+                resp.raise_for_status()
+                body = await resp.read()
+                self.etag = resp.headers.get("ETag")
+                self.modified = resp.headers.get("Last-Modified")
+                FEED_BYTES.observe(len(body))
+                return body
+        finally:
+            FEED_FETCH_SECONDS.observe(time.perf_counter() - started, status=status)
+
     async def __get_latest(self):
         try:
-            url = "https://api.mangaupdates.com/v1/releases/rss"
-            feed = feedparser.parse(url)
+            body = await RSSParser.__fetch(self)
         except:
             try:
-                url = "https://api.mangaupdates.com/v1/releases/rss"
-                feed = feedparser.parse(url)
+                body = await RSSParser.__fetch(self)
             except:
                 print("Error: Could not get MangaUpdates RSS feed.")
                 return None
-        return feed
+        return body
 
-    async def parse_feed(self):
-        feed = await RSSParser.__get_latest(self)
-        if feed is None:
-            return None
+    def parse_entries(self, entries):
         manga_list = []
-        for entry in feed.entries:
+        for entry in entries:
             title = entry.title
-            try:
-                chapter = re.search(r"(v.\d{1,} )?c.\d{1,}(\.\d)?(-\d{1,}(\.\d)?)?", title).group()
+            chapter = CHAPTER_RE.search(title)
+            if chapter is not None:
+                chapter = chapter.group()
                 title = title[0: len(title) - len(chapter) - 1]
-            except:
-                chapter = None
-            try:
-                scan_group = re.search("(?<=\[).+?(?=\])", title).group()
-                title = re.sub("(?<=\[).+?(?=\])", "", title)[3:]
-            except:
-                scan_group = None
-            try:
-                if (re.match("^http://", entry.link)):
-                    link = re.sub("^http://", "https://", entry.link)
-                else:
-                    link = entry.link
-            except:
-                link = None
-            
-            manga_list.append({"title": title, "chapter": chapter, "scan_group": scan_group, "link": link})
-        return manga_list
\ No newline at end of file
+            scan_group = GROUP_RE.search(title)
+            if scan_group is not None:
+                scan_group = scan_group.group()
+                title = GROUP_RE.sub("", title)[3:]
+            link = entry.get("link")
+            if link is not None:
+                link = HTTP_RE.sub("https://", link)
+            manga_list.append(Release(title, chapter, scan_group, link))
+        return manga_list
+
+    def __parse(self, body):
+        return self.parse_entries(feedparser.parse(body).entries)
+
+    async def parse_feed(self):
+        body = await RSSParser.__get_latest(self)
+        if body is None:
+            return None
+        if body is NOT_MODIFIED:
+            # a 304 hands back the previous list object untouched, callers can skip diffing on identity
+            return self.last
+        loop = asyncio.get_running_loop()
+        self.last = await loop.run_in_executor(None, self.__parse, body)
+        FEED_ENTRIES.set(len(self.last))
+        return self.last
@@ -0,0 +1,78 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+class SeriesIndex:
+    def __init__(self, mangaupdates, store=None, ttl=60 * 60 * 24 * 7, maxsize=5000, concurrency=5):
+        self.mangaupdates = mangaupdates
+        # mongo series collection (see Mongo.load_series/save_series), shared across restarts and processes
+        self.store = store
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.entries = OrderedDict()
+        self.titles = {}
+        self.hits = 0
+        self.fetched = 0
+
+    @staticmethod
+    def title_key(title):
+        return " ".join(title.split()).casefold()
+
+    @staticmethod
+    def from_info(info):
+        image = info.get("image") or {}
+        return {"id": info["series_id"], "title": info["title"], "image": (image.get("url") or {}).get("original"), "url": info.get("url"), "updated": time.time()}
+
+    def add(self, meta):
+        self.entries[meta["id"]] = meta
+        self.entries.move_to_end(meta["id"])
+        self.titles[SeriesIndex.title_key(meta["title"])] = meta["id"]
+        while len(self.entries) > self.maxsize:
+            old = self.entries.popitem(last=False)[1]
+            self.titles.pop(SeriesIndex.title_key(old["title"]), None)
+
+    def fresh(self, meta):
+        return meta is not None and time.time() - meta["updated"] < self.ttl
+
+    def get(self, series_id):
+        return self.entries.get(series_id)
+
+    def id_for_title(self, title):
+        return self.titles.get(SeriesIndex.title_key(title))
+
+    async def fetch(self, series_id):
+        async with self.semaphore:
+            info = await self.mangaupdates.series_info(series_id)
+        if "series_id" not in info:
+            return None
+        return SeriesIndex.from_info(info)
+
+    async def refresh(self, series_ids):
+        # bulk, lazy refresh for the ids seen in one tick: memory, then one store query, then the api for what is left
+        wanted = [i for i in dict.fromkeys(series_ids) if i is not None]
+        missing = [i for i in wanted if not self.fresh(self.entries.get(i))]
+        self.hits += len(wanted) - len(missing)
+        if missing and self.store is not None:
+            for meta in await self.store.load_series(missing):
+                if self.fresh(meta):
+                    self.add(meta)
+            missing = [i for i in missing if not self.fresh(self.entries.get(i))]
+        if not missing:
+            return
+        fetched = [meta for meta in await asyncio.gather(*[self.fetch(i) for i in missing], return_exceptions=True) if isinstance(meta, dict)]
+        self.fetched += len(fetched)
+        for meta in fetched:
+            self.add(meta)
+        if fetched and self.store is not None:
+            await self.store.save_series(fetched)
+
+    async def resolve_titles(self, titles):
+        # releases without a link, matched against titles already in the table
+        keys = [SeriesIndex.title_key(t) for t in titles if t and SeriesIndex.title_key(t) not in self.titles]
+        if keys and self.store is not None:
+            for meta in await self.store.find_series_by_title(keys):
+                self.add(meta)
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "fetched": self.fetched}
@@ -0,0 +1,82 @@
+import aiohttp
+import os
+from core.mongodb import Mongo
+from core.mangaupdates import MangaUpdates
+from core.rss import RSSParser
+from core.groups import GroupResolver
+from core.series import SeriesIndex
+from core.config import ConfigCache
+from core.cluster import ClusterClient, Lease
+from core.metrics import MetricsServer
+from core.watchdog import LoopWatchdog
+
+class Services:
+    def __init__(self):
+        self.session = None
+        self.mongo = None
+        self.mangaupdates = None
+        self.rss = None
+        self.groups = None
+        self.series = None
+        self.config = None
+        # only set when started by the cluster launcher (cluster.py)
+        self.cluster = None
+        self.lease = None
+        self.metrics = None
+        self.watchdog = None
+
+    async def start(self):
+        if self.session is not None:
+            return
+        # blocking calls on the loop make shard heartbeats late, this names the code that did it
+        self.watchdog = LoopWatchdog(threshold=float(os.environ.get("LOOP_WATCHDOG_THRESHOLD", 0.25)))
+        self.watchdog.start()
+        if os.environ.get("METRICS_PORT"):
+            # one port per cluster process
+            port = int(os.environ["METRICS_PORT"]) + int(os.environ.get("CLUSTER_ID", 0))
+            self.metrics = MetricsServer(os.environ.get("METRICS_HOST", "127.0.0.1"), port)
+            await self.metrics.start()
+        # one pool for every outbound http call (mangaupdates api + rss), keep-alive and cached dns
+        connector = aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=300, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+        self.mongo = Mongo()
+        await self.mongo.ensure_indexes()
+        if os.environ.get("CONFIG_CACHE") == "1":
+            self.config = ConfigCache(self.mongo, poll_interval=int(os.environ.get("CONFIG_POLL_INTERVAL", 30)))
+            self.mongo.config = self.config
+            await self.config.start()
+        cache_store = self.mongo if os.environ.get("MU_CACHE_STORE") == "1" else None
+        self.mangaupdates = MangaUpdates(self.session, cache_store=cache_store)
+        self.rss = RSSParser(self.session)
+        self.groups = GroupResolver(self.mangaupdates, store=self.mongo)
+        self.mangaupdates.on_group = self.groups.remember
+        await self.groups.load()
+        self.series = SeriesIndex(self.mangaupdates, store=self.mongo)
+        if os.environ.get("CLUSTER_SOCKET"):
+            self.cluster = ClusterClient(os.environ["CLUSTER_SOCKET"], int(os.environ["CLUSTER_ID"]), int(os.environ["CLUSTER_COUNT"]))
+            await self.cluster.connect()
+            # one cluster polls the feed and publishes releases, whichever holds this lease
+            self.lease = Lease(self.mongo, "rss")
+
+    async def close(self):
+        if self.watchdog is not None:
+            self.watchdog.stop()
+            self.watchdog = None
+        if self.metrics is not None:
+            await self.metrics.stop()
+            self.metrics = None
+        if self.lease is not None:
+            await self.lease.release()
+            self.lease = None
+        if self.cluster is not None:
+            await self.cluster.close()
+            self.cluster = None
+        if self.config is not None:
+            await self.config.stop()
+            self.config = None
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        if self.mongo is not None:
+            self.mongo.close()
+            self.mongo = None
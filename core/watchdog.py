@@ -0,0 +1,101 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from core.metrics import LOOP_LAG, REGISTRY
+
+STALLS = REGISTRY.counter("mu_loop_stalls_total", "Event loop stalls over the watchdog threshold by blocking call site", ("site",))
+BLOCKED_SECONDS = REGISTRY.counter("mu_loop_blocked_seconds_total", "Seconds the event loop was stalled by blocking call site", ("site",))
+
+# frames from this tree are preferred when naming a call site, the innermost frame is usually inside a library
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class LoopWatchdog:
+    # a coroutine ticks every interval, a thread watches the ticks. when the loop misses one by more than the
+    # threshold the thread grabs the loop thread's stack, and once the loop is back the stall is charged to that stack
+    def __init__(self, threshold=0.25, interval=0.1, keep=50):
+        self.threshold = threshold
+        self.interval = interval
+        self.keep = keep
+        self.offenders = {}
+        self.loop_thread = None
+        self.last_beat = None
+        self.sample = None
+        self.task = None
+        self.thread = None
+        self.stopped = False
+        self.stalls = 0
+        self.max_lag = 0.0
+        self.started = None
+
+    def start(self):
+        # called from the loop being watched
+        if self.task is not None:
+            return
+        self.loop_thread = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.started = time.time()
+        self.task = asyncio.create_task(self.beat())
+        self.thread = threading.Thread(target=self.watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        if self.task is not None:
+            self.task.cancel()
+
+    async def beat(self):
+        while True:
+            self.sample = None
+            self.last_beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - self.last_beat - self.interval)
+            LOOP_LAG.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                self.record(lag, self.sample)
+
+    def watch(self):
+        while not self.stopped:
+            time.sleep(self.interval / 2)
+            if self.sample is None and time.monotonic() - self.last_beat > self.interval + self.threshold:
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is not None:
+                    self.sample = traceback.extract_stack(frame)
+                del frame
+
+    @staticmethod
+    def site(stack):
+        if not stack:
+            # the loop came back before the thread looked, usually a stall just over the threshold
+            return "unknown"
+        ours = [f for f in stack if f.filename.startswith(ROOT) and "site-packages" not in f.filename]
+        frame = ours[-1] if ours else stack[-1]
+        return f"{os.path.relpath(frame.filename, ROOT) if ours else os.path.basename(frame.filename)}:{frame.lineno} {frame.name}"
+
+    def record(self, lag, stack):
+        self.stalls += 1
+        site = LoopWatchdog.site(stack)
+        STALLS.inc(site=site)
+        BLOCKED_SECONDS.inc(lag, site=site)
+        offender = self.offenders.get(site)
+        if offender is None:
+            if len(self.offenders) >= self.keep:
+                # forget the least costly one to keep the table bounded
+                del self.offenders[min(self.offenders, key=lambda s: self.offenders[s]["total"])]
+            offender = self.offenders[site] = {"site": site, "count": 0, "total": 0.0, "max": 0.0, "stack": None, "last": None}
+        offender["count"] += 1
+        offender["total"] += lag
+        offender["max"] = max(offender["max"], lag)
+        offender["last"] = time.time()
+        if stack:
+            offender["stack"] = "".join(traceback.format_list(stack[-8:]))
+
+    def top(self, n=5):
+        return sorted(self.offenders.values(), key=lambda o: o["total"], reverse=True)[:n]
+
+    def stats(self):
+        return {"stalls": self.stalls, "max_lag": self.max_lag, "sites": len(self.offenders)}
@@ -0,0 +1,49 @@
+# Builds the denormalized subscriptions collection from the manga lists in servers and users.
+# Safe to re-run, every subscription is upserted by id. Enable reads from it with MONGO_SUBSCRIPTIONS=1.
+#   python -m scripts.build_subscriptions [--drop]
+import argparse
+import time
+from dotenv import load_dotenv
+from pymongo import ReplaceOne
+from core.mongodb import Mongo
+
+
+def build(mongo, kind, collection, id_field, batch_size):
+    ops = []
+    written = 0
+    projection = {id_field: 1, "manga": 1}
+    if kind == "server":
+        projection["channelid"] = 1
+    for doc in collection.find({}, projection):
+        for manga in doc.get("manga", []):
+            sub = Mongo.subscription_doc(kind, doc[id_field], manga, doc.get("channelid"))
+            ops.append(ReplaceOne({"_id": sub["_id"]}, sub, upsert=True))
+            if len(ops) >= batch_size:
+                mongo.subs.bulk_write(ops, ordered=False)
+                written += len(ops)
+                ops = []
+    if ops:
+        mongo.subs.bulk_write(ops, ordered=False)
+        written += len(ops)
+    return written
+
+
+def main(args):
+    load_dotenv()
+    mongo = Mongo(use_subscriptions=True)
+    start = time.perf_counter()
+    if args.drop:
+        mongo.subs.drop()
+    servers = build(mongo, "server", mongo.srv, "serverid", args.batch_size)
+    users = build(mongo, "user", mongo.usr, "userid", args.batch_size)
+    mongo.ensure_indexes_sync()
+    print(f"Wrote {servers} server and {users} user subscriptions in {time.perf_counter() - start:.1f}s "
+          f"({mongo.subs.estimated_document_count()} total).")
+    mongo.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--drop", action="store_true", help="drop the collection first instead of upserting into it")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    main(parser.parse_args())
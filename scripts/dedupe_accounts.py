@@ -0,0 +1,80 @@
+# Merges servers and users that were set up more than once and puts the unique serverid/userid indexes in place.
+# Setup now upserts on those indexes, so without them two concurrent setups could still create two documents.
+# Duplicates are merged into the oldest document: manga lists are combined (first entry per manga id wins),
+# fields missing on the oldest are taken from the newer ones, then the newer documents are deleted.
+#   python -m scripts.dedupe_accounts [--dry-run]
+import argparse
+import time
+from dotenv import load_dotenv
+from pymongo import UpdateOne, DeleteMany
+from core.mongodb import Mongo
+
+
+def merge(docs):
+    keep = docs[0]
+    manga = list(keep.get("manga", []))
+    ids = set(m["id"] for m in manga)
+    fields = {}
+    for doc in docs[1:]:
+        for m in doc.get("manga", []):
+            if m["id"] not in ids:
+                ids.add(m["id"])
+                manga.append(m)
+        for field, value in doc.items():
+            if field not in keep and field not in fields and field != "_id":
+                fields[field] = value
+    fields["manga"] = manga
+    return keep["_id"], fields, [doc["_id"] for doc in docs[1:]]
+
+
+def dedupe(collection, id_field, dry_run):
+    # int _ids from the old count-based allocation sort before ObjectIds, so the first id in each group is the oldest
+    pipeline = [
+        {"$sort": {"_id": 1}},
+        {"$group": {"_id": f"${id_field}", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+    ops = []
+    removed = 0
+    for group in collection.aggregate(pipeline, allowDiskUse=True):
+        docs = sorted(collection.find({"_id": {"$in": group["ids"]}}), key=lambda doc: group["ids"].index(doc["_id"]))
+        keep, fields, extra = merge(docs)
+        print(f"{collection.name} {id_field}={group['_id']}: keeping {keep}, merging {len(extra)} duplicates ({len(fields['manga'])} manga)")
+        ops.append(UpdateOne({"_id": keep}, {"$set": fields}))
+        ops.append(DeleteMany({"_id": {"$in": extra}}))
+        removed += len(extra)
+    if ops and not dry_run:
+        collection.bulk_write(ops, ordered=True)
+    return removed
+
+
+def unique_index(mongo, collection, id_field):
+    # an earlier startup may have fallen back to a plain index because of the duplicates, replace it
+    for name, info in collection.index_information().items():
+        if info["key"] == [(id_field, 1)] and not info.get("unique"):
+            print(f"Dropping non-unique index {collection.name}.{name}")
+            collection.drop_index(name)
+    mongo.ensure_index(collection, id_field, unique=True)
+
+
+def main(args):
+    load_dotenv()
+    mongo = Mongo()
+    start = time.perf_counter()
+    servers = dedupe(mongo.srv, "serverid", args.dry_run)
+    users = dedupe(mongo.usr, "userid", args.dry_run)
+    if args.dry_run:
+        print(f"Dry run: would remove {servers} duplicate servers and {users} duplicate users.")
+    else:
+        unique_index(mongo, mongo.srv, "serverid")
+        unique_index(mongo, mongo.usr, "userid")
+        print(f"Removed {servers} duplicate servers and {users} duplicate users in {time.perf_counter() - start:.1f}s.")
+        if mongo.use_subscriptions and servers + users:
+            print("Subscriptions may reference merged lists, re-run python -m scripts.build_subscriptions --drop.")
+    mongo.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true", help="show the duplicates without merging them")
+    main(parser.parse_args())
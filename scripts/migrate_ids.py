@@ -0,0 +1,194 @@
+# Moves manga and scan group ids in servers and users from the old mangaupdates ids (series.html?id=123)
+# to the new base36 ones. Every legacy id is resolved once no matter how many lists contain it, resolved ids
+# are kept in a checkpoint file so an interrupted run picks up where it stopped, and the writes are batched.
+#   python -m scripts.migrate_ids [--dry-run] [--rate 1] [--checkpoint migrate_ids.json]
+import argparse
+import asyncio
+import json
+import os
+import time
+import aiohttp
+from dotenv import load_dotenv
+from pymongo import UpdateMany
+from core.outbound import TokenBucket
+from core.mangaupdates import MangaUpdates, SERIES_LINK_RE, GROUP_LINK_RE, LEGACY_ID_MAX
+from core.mongodb import Mongo
+
+PAGES = {
+    "series": ("https://www.mangaupdates.com/series.html?id={}", SERIES_LINK_RE),
+    "groups": ("https://www.mangaupdates.com/groups.html?id={}", GROUP_LINK_RE),
+}
+FIELDS = {"series": "id", "groups": "groupid"}
+
+
+def legacy_id(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str) and value.isdigit():
+        value = int(value)
+    if isinstance(value, int) and 0 < value < LEGACY_ID_MAX:
+        return value
+    return None
+
+
+def collect(mongo):
+    # {"series": {old id: set of stored values}, "groups": {...}}, values are kept as stored (int or str) for the writes
+    found = {"series": {}, "groups": {}}
+    documents = 0
+    for collection in (mongo.srv, mongo.usr):
+        for doc in collection.find({}, {"manga.id": 1, "manga.groupid": 1}):
+            documents += 1
+            for manga in doc.get("manga", []):
+                for kind, field in FIELDS.items():
+                    old = legacy_id(manga.get(field))
+                    if old is not None:
+                        found[kind].setdefault(old, set()).add(manga[field])
+    return found, documents
+
+
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.data = {"series": {}, "groups": {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.data.update(json.load(f))
+
+    def get(self, kind, old):
+        return self.data[kind].get(str(old))
+
+    def done(self, kind, old):
+        return str(old) in self.data[kind]
+
+    def set(self, kind, old, new):
+        self.data[kind][str(old)] = new
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self.path)
+
+
+class Resolver:
+    def __init__(self, session, checkpoint, rate, concurrency, save_every=25):
+        self.session = session
+        self.checkpoint = checkpoint
+        # one page at a time, evenly spaced
+        self.bucket = TokenBucket(1, 1 / rate)
+        self.concurrency = concurrency
+        self.save_every = save_every
+        self.resolved = 0
+        self.failed = 0
+        self.started = time.perf_counter()
+
+    async def resolve(self, kind, old):
+        url, pattern = PAGES[kind]
+        for attempt in range(3):
+            await self.bucket.acquire()
+            try:
+                new = await MangaUpdates.read_canonical(self.session, url.format(old), pattern)
+                return int(new, 36) if new else None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Error: {kind} {old} attempt {attempt + 1} failed: {e!r}")
+                if attempt == 2:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+
+    def progress(self, total):
+        done = self.resolved + self.failed
+        elapsed = time.perf_counter() - self.started
+        rate = done / elapsed if elapsed else 0.0
+        eta = (total - done) / rate if rate else 0.0
+        print(f"{done}/{total} done ({self.failed} failed), {rate:.2f} ids/s, eta {eta:.0f}s")
+
+    async def run(self, todo):
+        queue = asyncio.Queue()
+        for item in todo:
+            queue.put_nowait(item)
+
+        async def worker():
+            while True:
+                try:
+                    kind, old = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    new = await self.resolve(kind, old)
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    # not checkpointed, picked up again on the next run
+                    self.failed += 1
+                else:
+                    # pages without a canonical link are checkpointed as None so they aren't fetched again
+                    self.checkpoint.set(kind, old, new)
+                    self.resolved += 1
+                if (self.resolved + self.failed) % self.save_every == 0:
+                    self.checkpoint.save()
+                    self.progress(len(todo))
+
+        await asyncio.gather(*[worker() for _ in range(min(self.concurrency, len(todo)))])
+        self.checkpoint.save()
+        self.progress(len(todo))
+
+
+def updates(found, checkpoint):
+    # one UpdateMany per legacy id and field, array filters rewrite every matching entry in every list at once
+    ops = []
+    for kind, field in FIELDS.items():
+        for old, stored in found[kind].items():
+            new = checkpoint.get(kind, old)
+            if new is None:
+                continue
+            stored = list(stored)
+            ops.append(UpdateMany({f"manga.{field}": {"$in": stored}}, {"$set": {f"manga.$[m].{field}": new}}, array_filters=[{f"m.{field}": {"$in": stored}}]))
+    return ops
+
+
+def write(mongo, ops, batch_size):
+    matched = modified = 0
+    for collection in (mongo.srv, mongo.usr):
+        for i in range(0, len(ops), batch_size):
+            result = collection.bulk_write(ops[i:i + batch_size], ordered=False)
+            matched += result.matched_count
+            modified += result.modified_count
+    return matched, modified
+
+
+async def main(args):
+    load_dotenv()
+    mongo = Mongo()
+    start = time.perf_counter()
+    found, documents = collect(mongo)
+    checkpoint = Checkpoint(args.checkpoint)
+    todo = [(kind, old) for kind in FIELDS for old in sorted(found[kind]) if not checkpoint.done(kind, old)]
+    print(f"Scanned {documents} documents: {len(found['series'])} legacy series ids and {len(found['groups'])} legacy group ids, "
+          f"{len(todo)} left to resolve ({args.checkpoint}).")
+
+    if todo:
+        timeout = aiohttp.ClientTimeout(total=30)
+        async with aiohttp.ClientSession(timeout=timeout, headers={"User-Agent": "MangaUpdatesBot id migration"}) as session:
+            await Resolver(session, checkpoint, args.rate, args.concurrency).run(todo)
+
+    ops = updates(found, checkpoint)
+    unresolved = sum(1 for kind in FIELDS for old in found[kind] if checkpoint.get(kind, old) is None)
+    if args.dry_run:
+        print(f"Dry run: would run {len(ops)} updates on servers and users, {unresolved} ids could not be resolved.")
+        for op in ops[:10]:
+            print(f"  {op._filter} -> {op._doc}")
+    else:
+        matched, modified = await mongo.run("migrate_ids", write, mongo, ops, args.batch_size)
+        print(f"Updated {modified} of {matched} matched documents with {len(ops)} updates, {unresolved} ids could not be resolved.")
+        if mongo.use_subscriptions:
+            print("Subscriptions are keyed by manga id, re-run python -m scripts.build_subscriptions --drop.")
+    print(f"Done in {time.perf_counter() - start:.1f}s.")
+    mongo.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true", help="resolve ids and show the updates without writing them")
+    parser.add_argument("--rate", type=float, default=1.0, help="page requests per second to mangaupdates")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--checkpoint", default="migrate_ids.json", help="resolved ids are saved here, delete it to start over")
+    parser.add_argument("--batch-size", type=int, default=500)
+    asyncio.run(main(parser.parse_args()))